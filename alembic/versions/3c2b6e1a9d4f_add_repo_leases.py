@@ -0,0 +1,34 @@
+"""Add repo leases
+
+Revision ID: 3c2b6e1a9d4f
+Revises: 70a58ae9f90
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3c2b6e1a9d4f'
+down_revision = '70a58ae9f90'
+
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('repo_leases',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('tag', sa.Unicode(length=64), nullable=False),
+        sa.Column('owner', sa.Unicode(length=255), nullable=False),
+        sa.Column('acquired', sa.DateTime(), default=datetime.utcnow,
+                  nullable=False),
+        sa.Column('heartbeat', sa.DateTime(), default=datetime.utcnow,
+                  nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('tag')
+    )
+
+
+def downgrade():
+    op.drop_table('repo_leases')
@@ -12,11 +12,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import time
 import logging
 import xmlrpclib
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from kitchen.text.converters import to_unicode
 from bunch import Bunch
+from bodhi import stats
 from bodhi.config import config
 
 log = logging.getLogger('bodhi')
@@ -27,7 +33,8 @@ class BugTracker(object):
     def _(self, *args, **kw):  # pragma: no cover
         raise NotImplementedError
 
-    getbug = update_details = modified = on_qa = close = update_details = _
+    getbug = getbugs = update_details = modified = on_qa = close = \
+        update_details = _
 
 
 class FakeBugTracker(BugTracker):
@@ -35,6 +42,9 @@ class FakeBugTracker(BugTracker):
     def getbug(self, bug_id, *args, **kw):
         return Bunch(bug_id=int(bug_id))
 
+    def getbugs(self, bug_ids):
+        return [self.getbug(bug_id) for bug_id in bug_ids]
+
     def __noop__(self, *args, **kw):
         log.debug('__noop__(%s)' % str(args))
 
@@ -49,19 +59,29 @@ class InvalidComment(Exception):
 
 
 class Bugzilla(BugTracker):
+    """
+    Talk to bugzilla over one connection per thread, since a connection can
+    not be shared between threads.
+    """
 
     def __init__(self):
-        user = config.get('bodhi_email')
-        password = config.get('bodhi_password', None)
-        url = config.get("bz_server")
-        log.info("Using BZ URL %s" % url)
-        if user and password:
-            self.bz = bugzilla.Bugzilla(url=url,
-                                        user=user, password=password,
-                                        cookiefile=None, tokenfile=None)
-        else:
-            self.bz = bugzilla.Bugzilla(url=url,
-                                        cookiefile=None, tokenfile=None)
+        self._local = threading.local()
+        log.info("Using BZ URL %s" % config.get("bz_server"))
+
+    @property
+    def bz(self):
+        if getattr(self._local, 'bz', None) is None:
+            user = config.get('bodhi_email')
+            password = config.get('bodhi_password', None)
+            url = config.get("bz_server")
+            if user and password:
+                self._local.bz = bugzilla.Bugzilla(
+                    url=url, user=user, password=password,
+                    cookiefile=None, tokenfile=None)
+            else:
+                self._local.bz = bugzilla.Bugzilla(
+                    url=url, cookiefile=None, tokenfile=None)
+        return self._local.bz
 
     def get_url(self, bug_id):
         return "%s/show_bug.cgi?id=%s" % (config['bz_baseurl'], bug_id)
@@ -69,34 +89,58 @@ class Bugzilla(BugTracker):
     def getbug(self, bug_id):
         return self.bz.getbug(bug_id)
 
-    def comment(self, bug_id, comment):
+    def getbugs(self, bug_ids):
+        """
+        Fetch many bugs in one round trip, and keep them for the calls that
+        this thread makes next, until its next getbugs().
+        """
+        bugs = [bug for bug in self.bz.getbugs(bug_ids) if bug]
+        self._local.bugs = dict((bug.bug_id, bug) for bug in bugs)
+        return bugs
+
+    def _getbug(self, bug_id):
+        """ Return a bug prefetched by getbugs(), or fetch it """
+        bugs = getattr(self._local, 'bugs', None) or {}
+        if bug_id in bugs:
+            return bugs[bug_id]
+        return self.bz.getbug(bug_id)
+
+    def comment(self, bug_id, comment, raise_errors=False):
         try:
             if len(comment) > 65535:
                 raise InvalidComment("Comment is too long: %s" % comment)
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             bug.addcomment(comment)
         except InvalidComment:
             log.exception(
                 "Comment too long for bug #%d:  %s" % (bug_id, comment))
         except:
             log.exception("Unable to add comment to bug #%d" % bug_id)
+            if raise_errors:
+                raise
 
-    def on_qa(self, bug_id, comment):
+    def on_qa(self, bug_id, comment, raise_errors=False):
         """
         Change the status of this bug to ON_QA, and comment on the bug with
         some details on how to test and provide feedback for this update.
+
+        Failures are logged, and only raised if `raise_errors` is set, as it
+        is by the BugWorkQueue so that it can retry them.  The same goes for
+        comment(), close() and modified().
         """
         log.debug("Setting Bug #%d to ON_QA" % bug_id)
         try:
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             bug.setstatus('ON_QA', comment=comment)
         except:
             log.exception("Unable to alter bug #%d" % bug_id)
+            if raise_errors:
+                raise
 
-    def close(self, bug_id, versions):
+    def close(self, bug_id, versions, raise_errors=False):
         args = {}
         try:
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             # If this bug is for one of these builds...
             if bug.component in versions:
                 version = versions[bug.component]
@@ -117,11 +161,13 @@ class Bugzilla(BugTracker):
             bug.close('ERRATA', **args)
         except xmlrpclib.Fault:
             log.exception("Unable to close bug #%d" % bug_id)
+            if raise_errors:
+                raise
 
     def update_details(self, bug, bug_entity):
         if not bug:
             try:
-                bug = self.bz.getbug(bug_entity.bug_id)
+                bug = self._getbug(bug_entity.bug_id)
             except xmlrpclib.Fault:
                 bug_entity.title = 'Invalid bug number'
                 log.exception("Got fault from Bugzilla")
@@ -138,9 +184,9 @@ class Bugzilla(BugTracker):
         if 'security' in [keyword.lower() for keyword in keywords]:
             bug_entity.security = True
 
-    def modified(self, bug_id):
+    def modified(self, bug_id, raise_errors=False):
         try:
-            bug = self.bz.getbug(bug_id)
+            bug = self._getbug(bug_id)
             if bug.product not in config.get('bz_products', '').split(','):
                 log.info("Skipping %r bug" % bug.product)
                 return
@@ -149,12 +195,115 @@ class Bugzilla(BugTracker):
                 bug.setstatus('MODIFIED')
         except:
             log.exception("Unable to alter bug #%d" % bug_id)
+            if raise_errors:
+                raise
+
+
+class RateLimiter(object):
+    """ Space out calls made from any number of threads to `rate` a second """
+
+    def __init__(self, rate):
+        self.interval = rate and 1.0 / rate or 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BugWorkQueue(BugTracker):
+    """
+    Collect bugtracker calls, and run them all at once on a pool of
+    `bz_workers` threads when join() is called.
+
+    The bugs are split into chunks that are each prefetched with a single
+    getbugs() call, and the calls for a bug are made in the order they were
+    queued.  No more than `bz_rate_limit` calls are made a second, and calls
+    that fail are retried up to `bz_retries` times.
+    """
+
+    def __init__(self, tracker=None):
+        self.tracker = tracker or bugtracker
+        self.workers = int(config.get('bz_workers', 4))
+        self.retries = int(config.get('bz_retries', 3))
+        self.chunk_size = int(config.get('bz_prefetch_chunk_size', 100))
+        self.limiter = RateLimiter(float(config.get('bz_rate_limit', 10)))
+        self.calls = OrderedDict()
+
+    def _put(self, bug_id, method, *args, **kw):
+        self.calls.setdefault(bug_id, []).append((method, args, kw))
+
+    def getbug(self, bug_id, *args, **kw):
+        return self.tracker.getbug(bug_id, *args, **kw)
+
+    def comment(self, bug_id, comment):
+        self._put(bug_id, 'comment', bug_id, comment, raise_errors=True)
+
+    def on_qa(self, bug_id, comment):
+        self._put(bug_id, 'on_qa', bug_id, comment, raise_errors=True)
+
+    def close(self, bug_id, versions):
+        self._put(bug_id, 'close', bug_id, versions=versions,
+                  raise_errors=True)
+
+    def modified(self, bug_id):
+        self._put(bug_id, 'modified', bug_id, raise_errors=True)
+
+    def update_details(self, bug, bug_entity):
+        self._put(bug_entity.bug_id, 'update_details', bug, bug_entity)
+
+    def join(self):
+        """ Run every queued call, and return how many of them failed """
+        bug_ids = list(self.calls)
+        chunks = [bug_ids[i:i + self.chunk_size]
+                  for i in range(0, len(bug_ids), self.chunk_size)]
+        if not chunks:
+            return 0
+        pool = ThreadPool(min(len(chunks), self.workers),
+                          stats.adopt, (stats.current(),))
+        try:
+            failures = sum(pool.map(self._work, chunks))
+        finally:
+            pool.close()
+            pool.join()
+        self.calls = OrderedDict()
+        if failures:
+            log.error('%d bugzilla calls failed', failures)
+        return failures
+
+    def _work(self, bug_ids):
+        # If the prefetch fails, every call just fetches its own bug
+        self._call('getbugs', bug_ids)
+        failures = 0
+        for bug_id in bug_ids:
+            for method, args, kw in self.calls[bug_id]:
+                if not self._call(method, *args, **kw):
+                    failures += 1
+        return failures
+
+    def _call(self, method, *args, **kw):
+        for attempt in range(1, self.retries + 2):
+            self.limiter.wait()
+            try:
+                getattr(self.tracker, method)(*args, **kw)
+                return True
+            except Exception:
+                log.exception('Bugzilla %s%r failed (attempt %d)',
+                              method, args, attempt)
+        return False
 
 
 if config.get('bugtracker') == 'bugzilla':
     import bugzilla
     log.info('Using python-bugzilla')
-    bugtracker = Bugzilla()
+    bugtracker = stats.CallCounter(Bugzilla(), 'bugzilla')
 else:
     log.info('Using the FakeBugTracker')
-    bugtracker = FakeBugTracker()
+    bugtracker = stats.CallCounter(FakeBugTracker(), 'bugzilla')
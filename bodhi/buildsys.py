@@ -14,9 +14,12 @@
 
 import time
 import logging
+import functools
 
 from os.path import join, expanduser
 
+from bodhi import stats
+
 log = logging.getLogger('bodhi')
 
 _buildsystem = None
@@ -74,6 +77,28 @@ class Buildsystem:
         raise NotImplementedError
 
 
+def multicall_enabled(method):
+    """
+    Make a DevBuildsys method behave like koji while in multicall mode: the
+    call returns nothing and its result (or fault) is handed back, along with
+    the others, by the next multiCall().
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kw):
+        if not self.multicall:
+            return method(self, *args, **kw)
+        # Calls made from within this method should not get queued
+        self.multicall = False
+        try:
+            self._multicall_results.append([method(self, *args, **kw)])
+        except Exception as e:
+            self._multicall_results.append({'faultCode': 1000,
+                                            'faultString': str(e)})
+        finally:
+            self.multicall = True
+    return wrapper
+
+
 class DevBuildsys(Buildsystem):
     """
     A dummy buildsystem instance used during development and testing
@@ -84,6 +109,10 @@ class DevBuildsys(Buildsystem):
     __tagged__ = {}
     __rpms__ = []
 
+    def __init__(self):
+        self.multicall = False
+        self._multicall_results = []
+
     def clear(self):
         DevBuildsys.__untag__ = []
         DevBuildsys.__moved__ = []
@@ -92,16 +121,21 @@ class DevBuildsys(Buildsystem):
         DevBuildsys.__rpms__ = []
 
     def multiCall(self):
-        return []
+        results, self._multicall_results = self._multicall_results, []
+        self.multicall = False
+        return results
 
+    @multicall_enabled
     def moveBuild(self, from_tag, to_tag, build, *args, **kw):
         log.debug("moveBuild(%s, %s, %s)" % (from_tag, to_tag, build))
         DevBuildsys.__moved__.append((from_tag, to_tag, build))
 
+    @multicall_enabled
     def tagBuild(self, tag, build, *args, **kw):
         log.debug("tagBuild(%s, %s)" % (tag, build))
         DevBuildsys.__added__.append((tag, build))
 
+    @multicall_enabled
     def untagBuild(self, tag, build, *args, **kw):
         log.debug("untagBuild(%s, %s)" % (tag, build))
         DevBuildsys.__untag__.append((tag, build))
@@ -109,17 +143,21 @@ class DevBuildsys(Buildsystem):
     def ssl_login(self, *args, **kw):
         log.debug("ssl_login(%s, %s)" % (args, kw))
 
+    @multicall_enabled
     def taskFinished(self, task):
         return True
 
+    @multicall_enabled
     def getTaskInfo(self, task):
         return {'state': koji.TASK_STATES['CLOSED']}
 
+    @multicall_enabled
     def listPackages(self):
         return [
             {'package_id': 2625, 'package_name': 'nethack'},
         ]
 
+    @multicall_enabled
     def getBuild(self, build='TurboGears-1.0.2.2-2.fc7', other=False):
         data = {'build_id': 16058,
                 'completion_time': '2007-08-24 23:26:10.890319',
@@ -163,6 +201,7 @@ class DevBuildsys(Buildsystem):
 
         return data
 
+    @multicall_enabled
     def listBuildRPMs(self, id, *args, **kw):
         rpms = [{'arch': 'src',
                  'build_id': 6475,
@@ -195,6 +234,7 @@ class DevBuildsys(Buildsystem):
         rpms += DevBuildsys.__rpms__
         return rpms
 
+    @multicall_enabled
     def listTags(self, build, *args, **kw):
         if 'el5' in build:
             result = [{'arches': 'i386 x86_64 ppc ppc64', 'id': 10, 'locked': True,
@@ -216,6 +256,7 @@ class DevBuildsys(Buildsystem):
                 result += [{'name': tag}]
         return result
 
+    @multicall_enabled
     def listTagged(self, tag, *args, **kw):
         builds = []
         for build in [self.getBuild(), self.getBuild(other=True)]:
@@ -230,9 +271,11 @@ class DevBuildsys(Buildsystem):
                     builds.append(self.getBuild(build))
         return builds
 
+    @multicall_enabled
     def getLatestBuilds(self, *args, **kw):
         return [self.getBuild()]
 
+    @multicall_enabled
     def getTag(self, taginfo, **kw):
         if isinstance(taginfo, int):
             taginfo = "f%d" % taginfo
@@ -248,6 +291,7 @@ class DevBuildsys(Buildsystem):
                 'perm': None, 'id': 246, 'arches': None,
                 'maven_include_all': False, 'perm_id': None}
 
+    @multicall_enabled
     def getRPMHeaders(self, rpmID, headers):
         return {
             'description':
@@ -311,8 +355,8 @@ def get_session():
     global _buildsystem
     if not _buildsystem:
         log.warning('No buildsystem configured; assuming testing')
-        return DevBuildsys()
-    return _buildsystem()
+        return stats.CallCounter(DevBuildsys(), 'koji')
+    return stats.CallCounter(_buildsystem(), 'koji')
 
 
 def setup_buildsystem(settings):
@@ -332,24 +376,79 @@ def setup_buildsystem(settings):
         _buildsystem = DevBuildsys
 
 
+def chunked_multicall(session, method, args, chunk_size=250):
+    """
+    Call a koji method once for every tuple of arguments in `args`, batching
+    the calls into multicalls of at most `chunk_size` calls each.  A dict may
+    be given instead of a tuple to pass keyword arguments.
+
+    Return the results in the same order as the arguments.  Calls that fail
+    are logged and have a result of None.
+    """
+    results = []
+    for i in range(0, len(args), chunk_size):
+        chunk = args[i:i + chunk_size]
+        session.multicall = True
+        for arg in chunk:
+            if isinstance(arg, dict):
+                getattr(session, method)(**arg)
+            else:
+                getattr(session, method)(*arg)
+        for arg, result in zip(chunk, session.multiCall()):
+            if isinstance(result, dict):
+                log.error("%s(%r) failed: %s" % (method, arg,
+                                                 result.get('faultString')))
+                results.append(None)
+            else:
+                results.append(result[0])
+    return results
+
+
 def wait_for_tasks(tasks, session=None, sleep=300):
     """
-    Wait for a list of koji tasks to complete.  Return the first task number
-    to fail, otherwise zero.
+    Wait for a list of koji tasks to complete.  Return a list of the tasks
+    that failed.
+
+    All of the pending tasks are polled at once with a single multicall each
+    time around, rather than one call per task.
     """
     log.debug("Waiting for %d tasks to complete: %s" % (len(tasks), tasks))
     failed_tasks = []
     if not session:
         session = get_session()
+    pending = []
     for task in tasks:
         if not task:
             log.debug("Skipping task: %s" % task)
             continue
-        while not session.taskFinished(task):
+        pending.append(task)
+    while pending:
+        session.multicall = True
+        for task in pending:
+            session.taskFinished(task)
+        finished, unfinished = [], []
+        for task, result in zip(pending, session.multiCall()):
+            if isinstance(result, dict):
+                log.error("Unable to poll koji task %d: %s" % (
+                    task, result.get('faultString')))
+                failed_tasks.append(task)
+            elif result[0]:
+                finished.append(task)
+            else:
+                unfinished.append(task)
+
+        if finished:
+            session.multicall = True
+            for task in finished:
+                session.getTaskInfo(task)
+            for task, result in zip(finished, session.multiCall()):
+                if (isinstance(result, dict) or
+                        result[0]['state'] != koji.TASK_STATES['CLOSED']):
+                    log.error("Koji task %d failed" % task)
+                    failed_tasks.append(task)
+
+        pending = unfinished
+        if pending:
             time.sleep(sleep)
-        task_info = session.getTaskInfo(task)
-        if task_info['state'] != koji.TASK_STATES['CLOSED']:
-            log.error("Koji task %d failed" % task)
-            failed_tasks.append(task)
     log.debug("Tasks completed successfully!")
     return failed_tasks
@@ -20,56 +20,192 @@ mashed.
 """
 
 import os
+import re
+import socket
 import copy
+import codecs
+import glob
+import shutil
 import functools
 import json
 import time
 import urllib2
 import hashlib
 import threading
+import multiprocessing
 import fedmsg.consumers
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing.pool import ThreadPool
 from pyramid.paster import get_appsettings
 from sqlalchemy import engine_from_config
+from sqlalchemy.orm import sessionmaker
 
-from bodhi import log, buildsys, notifications, mail, util
-from bodhi.util import sorted_updates, sanity_check_repodata, transactional_session_maker
+from bodhi import log, buildsys, notifications, mail, util, stats
+from bodhi.util import (sorted_updates, sanity_check_repodata,
+                        transactional_session_maker, get_nvr)
 from bodhi.config import config
-from bodhi.models import (Update, UpdateRequest, UpdateType, Release,
-                          UpdateStatus, ReleaseState, DBSession, Base)
+from bodhi.models import (Update, UpdateRequest, UpdateType, Release, Build,
+                          UpdateStatus, ReleaseState, RepoLease, DBSession,
+                          Base)
+from bodhi.bugs import BugWorkQueue
 from bodhi.metadata import ExtendedMetadata
 from bodhi.exceptions import BodhiException
 
+def stage(method):
+    """ A decorator that measures a stage of the mash into self.stage_stats.
+
+    The wall time, the koji, bugzilla and database calls, and the peak RSS of
+    every stage end up in a report that is written next to the mash.  A stage
+    that runs more than once is reported as the sum of its runs.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        report = self.stage_stats.setdefault(method.__name__, {})
+        with stats.measure(report):
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# Guards the comps checkout that every MasherThread builds from
+comps_lock = threading.Lock()
+
 
 def checkpoint(method):
-    """ A decorator for skipping sections of the mash when resuming.
+    """ A decorator for skipping stages of the mash when resuming.
+
+    The completion of each checkpointed stage is recorded in the mash state,
+    along with its return value, which must be small and JSON serializable.
+    When a push is resumed, completed stages are skipped and their recorded
+    value is returned instead.
 
-    We started working on this on deployment day, but don't really have time to
-    think about the rammifications right now... so we're going to leave the
-    decorator here, but not yet employ is in methods of the MasherThread.
+    Only stages with side effects outside of our database (koji, bugzilla,
+    the filesystem, fedmsg, mail) are checkpointed.  Database changes are
+    rolled back when a push fails, so those stages always run again.
     """
 
     key = method.__name__
 
     @functools.wraps(method)
     def wrapper(self, *args, **kwargs):
-        if not self.resume or not self.state.get(key):
+        if not self.resume or key not in self.state:
+            self.check_lease()
             # Call it
             retval = method(self, *args, **kwargs)
-            if retval is not None:
-                raise ValueError("checkpointed functions may not return stuff")
             # if it didn't raise an exception, mark the checkpoint
-            self.state[key] = True
-            self.save_state()
-        else:
-            # cool!  we don't need to do anything, since we ran last time
-            pass
-
-        return None
+            self.state[key] = True if retval is None else retval
+            self.record_state('set', key, self.state[key])
+            return retval
+
+        # cool!  we don't need to do anything, since we ran last time
+        self.log.info('Skipping completed stage: %s', key)
+        retval = self.state[key]
+        return None if retval is True else retval
     return wrapper
 
 
+class PushQueue(object):
+    """The repos waiting to be pushed.
+
+    The queue is kept in a JSON file, which is atomically rewritten on every
+    change, so that it survives a restart of the masher.  Repos that were
+    being pushed when the masher went down are resumed from their saved state.
+
+    Requests for a release and request that is already waiting are merged into
+    one push, unless either of them resumes a push, whose updates come from
+    its saved state.  A queued repo waits for a running push of the same repo,
+    and for a free slot when `max_concurrent_mashes` repos are being pushed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.changed = threading.Condition()
+        self.stopped = False
+        self.entries = []
+        if path and os.path.exists(path):
+            with file(path) as f:
+                self.entries = json.load(f)
+            for entry in self.entries:
+                if entry['running']:
+                    entry['running'] = False
+                    entry['resume'] = True
+
+    def save(self):
+        if not self.path:
+            return
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with file(tmp, 'w') as f:
+            json.dump(self.entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+
+    def add(self, release, request, updates, important=False, resume=False):
+        """Queue a push of `updates` to a repo"""
+        with self.changed:
+            for entry in self.entries:
+                if (not entry['running'] and not entry['resume'] and
+                        not resume and entry['release'] == release and
+                        entry['request'] == request):
+                    entry['updates'].extend(update for update in updates
+                                            if update not in entry['updates'])
+                    entry['important'] = entry['important'] or important
+                    break
+            else:
+                self.entries.append(dict(release=release, request=request,
+                                         updates=list(updates),
+                                         important=important, resume=resume,
+                                         running=False))
+            self.save()
+            self.changed.notify_all()
+
+    def next(self):
+        """
+        Claim the next repo to push, important repos first, then stable ones.
+
+        Block until a repo is ready to be pushed.  None is returned once the
+        queue has been stopped.
+        """
+        with self.changed:
+            while not self.stopped:
+                limit = int(config.get('max_concurrent_mashes', 8))
+                running = set((entry['release'], entry['request'])
+                              for entry in self.entries if entry['running'])
+                ready = [entry for entry in self.entries
+                         if not entry['running'] and
+                         (entry['release'], entry['request']) not in running]
+                if ready and len(running) < limit:
+                    entry = min(ready, key=lambda entry: (
+                        not entry['important'], entry['request'] != 'stable'))
+                    entry['running'] = True
+                    self.save()
+                    return entry
+                self.changed.wait()
+            return None
+
+    def done(self, entry):
+        """Remove a pushed repo from the queue"""
+        with self.changed:
+            self.entries = [other for other in self.entries
+                            if other is not entry]
+            self.save()
+            self.changed.notify_all()
+
+    def join(self):
+        """Block until every queued repo has been pushed"""
+        with self.changed:
+            while self.entries:
+                self.changed.wait()
+
+    def stop(self):
+        """Stop handing out repos to push"""
+        with self.changed:
+            self.stopped = True
+            self.changed.notify_all()
+
+
 class Masher(fedmsg.consumers.FedmsgConsumer):
     """The Bodhi Masher.
 
@@ -130,6 +266,9 @@ Once mash is done:
 
         buildsys.setup_buildsystem(config)
         self.mash_dir = mash_dir
+        self.queue = PushQueue(config.get(
+            'push_queue', os.path.join(mash_dir, 'push-queue.json')))
+        self.thread_class = MasherThread
         prefix = hub.config.get('topic_prefix')
         env = hub.config.get('environment')
         self.topic = prefix + '.' + env + '.' + hub.config.get('masher_topic')
@@ -138,8 +277,26 @@ Once mash is done:
             log.warn('No releng_fedmsg_certname defined'
                      'Cert validation disabled')
         super(Masher, self).__init__(hub, *args, **kw)
+        self.start_pusher()
         log.info('Bodhi masher listening on topic: %s' % self.topic)
 
+    def start_pusher(self):
+        """Start the thread that pushes the queued repos, starting with any
+        that were left in the queue by a previous run"""
+        self.threads = []
+        self.pusher = threading.Thread(target=self.push_queue, name='pusher')
+        self.pusher.daemon = True
+        self.pusher.start()
+
+    def stop(self):
+        """Stop pushing queued repos, wait for the running ones to be done,
+        and shut the consumer down"""
+        self.queue.stop()
+        self.pusher.join()
+        for thread in self.threads:
+            thread.join()
+        super(Masher, self).stop()
+
     def consume(self, msg):
         self.log.info(msg)
         if self.valid_signer:
@@ -174,11 +331,15 @@ Once mash is done:
     def work(self, msg):
         """Begin the push process.
 
-        Here we organize & prioritize the updates, and fire off seperate
-        threads for each reop tag being mashed.
+        Here we organize & prioritize the updates, and queue up a push of each
+        repo tag being mashed.  The pusher thread pushes them in seperate
+        threads, so we return straight away.
 
         If there are any security updates in the push, then those repositories
-        will be executed before all others.
+        will be started before all others, and stable repositories are started
+        before testing ones.  At most `max_concurrent_mashes` repositories are
+        pushed at once, and a repo that is already being pushed waits for
+        that push to finish.
         """
         body = msg['body']['msg']
         resume = body.get('resume', False)
@@ -188,48 +349,70 @@ Once mash is done:
             releases = self.organize_updates(session, body)
             batches = self.prioritize_updates(releases)
 
-        # Important repos first, then normal
+        for important, batch in zip((True, False), batches):
+            for release, request, updates in self.schedule_repos([batch]):
+                self.log.info('Queueing %s %s for %d updates', release,
+                              request, len(updates))
+                self.queue.add(release, request, updates, important, resume)
+
+    def push_queue(self):
+        """Push the queued repos as they become ready, until the queue is
+        stopped"""
+        while True:
+            # Block until a repo is ready and a slot is free
+            entry = self.queue.next()
+            if entry is None:
+                break
+            self.log.info('Starting thread for %s %s for %d updates',
+                          entry['release'], entry['request'],
+                          len(entry['updates']))
+            thread = self.thread_class(entry['release'], entry['request'],
+                                       entry['updates'], self.log,
+                                       self.db_factory, self.mash_dir,
+                                       entry['resume'],
+                                       done=functools.partial(
+                                           self.queue.done, entry))
+            thread.start()
+            self.threads = [other for other in self.threads
+                            if other.is_alive()] + [thread]
+
+    def schedule_repos(self, batches):
+        """Yield the repos of a push in the order they should be started.
+
+        Important repos come first, then normal, and within each batch the
+        stable repos are started before the testing ones.
+        """
         for batch in batches:
-            # Stable first, then testing
             for req in ('stable', 'testing'):
-                threads = []
                 for release, request, updates in batch:
                     if request == req:
-                        self.log.info('Starting thread for %s %s for %d updates',
-                                      release, request, len(updates))
-                        thread = MasherThread(release, request, updates,
-                                              self.log, self.db_factory,
-                                              self.mash_dir, resume)
-                        threads.append(thread)
-                        thread.start()
-                for thread in threads:
-                    thread.join()
-
-        self.log.info('Push complete!')
+                        yield release, request, updates
 
     def organize_updates(self, session, body):
         # {Release: {UpdateRequest: [Update,]}}
         releases = defaultdict(lambda: defaultdict(list))
+        updates = Update.get_by_titles(body['updates'], session)
+        found = set(update.title for update in updates)
         for title in body['updates']:
-            update = session.query(Update).filter_by(title=title).first()
-            if update:
-                if not update.request:
-                    self.log.info('%s request revoked' % update.title)
-                    continue
-                update.locked = True
-                repo = releases[update.release.name][update.request.value]
-                repo.append(update)
-            else:
+            if title not in found:
                 self.log.warn('Cannot find update: %s' % title)
+        for update in updates:
+            if not update.request:
+                self.log.info('%s request revoked' % update.title)
+                continue
+            update.locked = True
+            repo = releases[update.release.name][update.request.value]
+            repo.append(update)
         return releases
 
 
 class MasherThread(threading.Thread):
 
     def __init__(self, release, request, updates, log, db_factory,
-                 mash_dir, resume=False):
+                 mash_dir, resume=False, done=None):
         super(MasherThread, self).__init__()
         self.db_factory = db_factory
+        self.done = done
         self.log = log
         self.mash_dir = mash_dir
         self.request = UpdateRequest.from_string(request)
@@ -239,6 +422,13 @@ class MasherThread(threading.Thread):
         self.add_tags = []
         self.move_tags = []
         self.testing_digest = {}
+        self.stage_stats = OrderedDict()
+        self.mash_thread = None
+        self.heartbeat = None
+        self.tag_worker = threading.local()
+        self.lease_factory = None
+        self.lease_owner = u'%s:%d:%d' % (socket.gethostname(), os.getpid(),
+                                          id(self))
         self.state = {
             'updates': updates,
             'completed_repos': []
@@ -252,6 +442,13 @@ class MasherThread(threading.Thread):
                 self.db = None
         except:
             self.log.exception('MasherThread failed. Transaction rolled back.')
+        finally:
+            # Only now that our changes are committed can another masher
+            # take over the repo
+            self.release_lease()
+            # Let the Masher start the next repo in the push
+            if self.done:
+                self.done()
 
     def work(self):
         self.koji = buildsys.get_session()
@@ -273,7 +470,15 @@ class MasherThread(threading.Thread):
             self.skip_mash = True
 
         self.log.info('Running MasherThread(%s)' % self.id)
+        if not self.acquire_lease():
+            return
         self.init_state()
+        if self.resume and not os.path.exists(self.mash_lock):
+            # We crashed before the state was first saved, or after it was
+            # removed, so there is nothing to resume
+            self.log.warn('No masher lock to resume from: %s, starting a '
+                          'fresh push', self.mash_lock)
+            self.resume = False
         if not self.resume:
             self.init_path()
 
@@ -296,35 +501,32 @@ class MasherThread(threading.Thread):
             if self.request is UpdateRequest.stable:
                 self.perform_gating()
 
+            self.prefetch_tags()
             self.determine_and_perform_tag_actions()
 
             self.update_security_bugs()
 
             self.expire_buildroot_overrides()
             self.remove_pending_tags()
+            # Pick up the tags that we just moved and removed
+            self.prefetch_tags()
             self.update_comps()
 
-            if self.resume and self.path in self.state['completed_repos']:
-                self.log.info('Skipping completed repo: %s', self.path)
-                self.complete_requests()
-                # We still need to generate the testing digest, since it's stored in memory
-                self.generate_testing_digest()
-            else:
-                if not self.skip_mash:
-                    mash_thread = self.mash()
+            if not self.skip_mash:
+                mash_thread = self.mash()
 
-                # Things we can do while we're mashing
-                self.complete_requests()
-                self.generate_testing_digest()
+            # Things we can do while we're mashing
+            self.complete_requests()
+            self.prefetch_headers()
+            self.testing_digest = self.generate_testing_digest()
 
-                if not self.skip_mash:
+            if not self.skip_mash:
+                uinfo = None
+                if not self.stage_completed('update_repodata'):
                     uinfo = self.generate_updateinfo()
 
-                    self.wait_for_mash(mash_thread)
-
-                    uinfo.insert_updateinfo()
-                    uinfo.insert_pkgtags()
-                    uinfo.cache_repodata()
+                self.wait_for_mash(mash_thread)
+                self.update_repodata(uinfo)
 
             # Compose OSTrees from our freshly mashed repos
             if config.get('compose_atomic_trees'):
@@ -361,26 +563,26 @@ class MasherThread(threading.Thread):
             self.save_state()
             raise
         finally:
+            self.heartbeat.stop()
             self.finish(success)
 
+    @stage
     def load_updates(self):
         self.log.debug('Loading updates')
-        updates = []
-        for title in self.state['updates']:
-            update = self.db.query(Update).filter_by(title=title).first()
-            if update:
-                updates.append(update)
+        updates = Update.get_by_titles(self.state['updates'], self.db)
         if not updates:
             raise Exception('Unable to load updates: %r' %
                             self.state['updates'])
         self.updates = updates
 
+    @stage
     def unlock_updates(self):
         self.log.debug('Unlocking updates')
         for update in self.updates:
             update.locked = False
         self.db.flush()
 
+    @stage
     def check_all_karma_thresholds(self):
         """
         If we just pushed testing updates see if any of them now meet either of
@@ -395,6 +597,7 @@ class MasherThread(threading.Thread):
                 except BodhiException:
                     self.log.exception('Problem checking karma thresholds')
 
+    @stage
     def verify_updates(self):
         for update in list(self.updates):
             if update.request is not self.request:
@@ -409,10 +612,13 @@ class MasherThread(threading.Thread):
                 self.eject_from_mash(update, reason)
                 continue
 
+    @stage
     def perform_gating(self):
         self.log.debug('Performing gating.')
+        results = Update.prefetch_results(list(self.updates), config)
         for update in list(self.updates):
-            result, reason = update.check_requirements(self.db, config)
+            result, reason = update.check_requirements(self.db, config,
+                                                       results)
             if not result:
                 self.log.warn("%s failed gating: %s" % (update.title, reason))
                 self.eject_from_mash(update, reason)
@@ -423,8 +629,9 @@ class MasherThread(threading.Thread):
         log.warn(text)
         update.comment(text, author=u'bodhi')
         update.request = None
-        if update in self.state['updates']:
-            self.state['updates'].remove(update)
+        if update.title in self.state['updates']:
+            self.state['updates'].remove(update.title)
+            self.record_state('remove', 'updates', update.title)
         if update in self.updates:
             self.updates.remove(update)
         notifications.publish(
@@ -439,6 +646,53 @@ class MasherThread(threading.Thread):
             force=True,
         )
 
+    def acquire_lease(self):
+        """
+        Take the lease on our repo, so that no other masher pushes it at the
+        same time, and keep it alive while we push.
+
+        Returns False if another masher holds the lease, in which case it is
+        pushing the repo and there is nothing for us to do.
+        """
+        self.lease_factory = sessionmaker(bind=self.db.get_bind())
+        timeout = int(config.get('mash_lease_timeout', 600))
+        session = self.lease_factory()
+        try:
+            if not RepoLease.acquire(session, self.id, self.lease_owner,
+                                     timeout):
+                self.log.info('%s is being pushed by %s', self.id,
+                              RepoLease.holder(session, self.id))
+                self.lease_factory = None
+                return False
+        finally:
+            session.close()
+        self.log.info('Took the lease on %s', self.id)
+        self.heartbeat = LeaseHeartbeat(
+            self.lease_factory, self.id, self.lease_owner,
+            int(config.get('mash_lease_interval', 60)), self.log)
+        self.heartbeat.start()
+        return True
+
+    def check_lease(self):
+        """Stop the push if another masher has reclaimed our lease"""
+        if self.heartbeat is not None and self.heartbeat.lost:
+            raise Exception('Lost the lease on %s' % self.id)
+
+    def release_lease(self):
+        if self.lease_factory is None:
+            return
+        if self.heartbeat is not None:
+            self.heartbeat.stop()
+        session = self.lease_factory()
+        try:
+            RepoLease.release(session, self.id, self.lease_owner)
+            self.log.info('Released the lease on %s', self.id)
+        except Exception:
+            self.log.exception('Unable to release the lease on %s', self.id)
+        finally:
+            session.close()
+            self.lease_factory = None
+
     def init_path(self):
         self.path = os.path.join(self.mash_dir, self.id + '-' +
                                  time.strftime("%y%m%d.%H%M"))
@@ -455,21 +709,28 @@ class MasherThread(threading.Thread):
             self.log.error('Trying to do a fresh push and masher lock already '
                            'exists: %s' % self.mash_lock)
             raise Exception
+        self.journal = util.StateJournal(self.mash_lock)
 
     def save_state(self):
         """
         Save the state of this push so it can be resumed later if necessary
+
+        This compacts the journal of the changes made since the last save.
         """
-        with file(self.mash_lock, 'w') as lock:
-            json.dump(self.state, lock)
+        self.journal.compact(self.state)
         self.log.info('Masher lock saved: %s', self.mash_lock)
 
+    def record_state(self, op, key, value):
+        """Append a single change of our state to the journal"""
+        self.journal.append(op, key, value)
+
     def load_state(self):
         """
         Load the state of this push so it can be resumed later if necessary
         """
-        with file(self.mash_lock) as lock:
-            self.state = json.load(lock)
+        self.state = self.journal.replay()
+        # Start a fresh journal, which also drops any truncated last change
+        self.save_state()
         self.log.info('Masher state loaded from %s', self.mash_lock)
         self.log.info(self.state)
         for path in self.state['completed_repos']:
@@ -480,27 +741,75 @@ class MasherThread(threading.Thread):
         self.log.info('Resuming push without any completed repos')
         self.init_path()
 
+    def stage_completed(self, key):
+        """ Return whether a checkpointed stage was completed in a previous run """
+        return self.resume and key in self.state
+
     def remove_state(self):
         self.log.info('Removing state: %s', self.mash_lock)
-        os.remove(self.mash_lock)
+        self.journal.remove()
 
     def finish(self, success):
         self.log.info('Thread(%s) finished.  Success: %r' % (self.id, success))
+        self.report_stats()
         notifications.publish(
             topic="mashtask.complete",
             msg=dict(success=success, repo=self.id),
             force=True,
         )
 
+    def report_stats(self):
+        """
+        Write the stats of every stage next to the mash, if the push got as
+        far as choosing one, and publish them
+        """
+        if getattr(self, 'path', None):
+            report = os.path.join(self.mash_dir, '%s.stats.json' %
+                                  os.path.basename(self.path))
+            try:
+                with file(report, 'w') as f:
+                    json.dump(self.stage_stats, f, indent=2)
+                self.log.info('Stage stats written to %s', report)
+            except IOError:
+                self.log.exception('Unable to write stage stats to %s',
+                                   report)
+        notifications.publish(
+            topic="mashtask.stats",
+            msg=dict(repo=self.id, stages=self.stage_stats),
+            force=True,
+        )
+
+    @stage
     def update_security_bugs(self):
         """Update the bug titles for security updates"""
         self.log.info('Updating bug titles for security updates')
+        queue = BugWorkQueue()
         for update in self.updates:
             if update.type is UpdateType.security:
                 for bug in update.bugs:
-                    bug.update_details()
+                    bug.update_details(tracker=queue)
+        queue.join()
+
+    @stage
+    def prefetch_tags(self):
+        """Look up the koji tags of every build in this push at once"""
+        self.log.debug('Prefetching koji tags')
+        Build.prefetch_tags(sum([update.builds for update in self.updates],
+                                []), self.koji)
+
+    @stage
+    def prefetch_headers(self):
+        """
+        Look up the rpm headers and latest builds that the update notices of
+        this push need, a chunk of updates at a time.
+        """
+        self.log.debug('Prefetching rpm headers and latest builds')
+        for chunk in self.chunk_updates():
+            Build.prefetch_headers(sum([update.builds for update in chunk],
+                                       []), self.koji)
 
     @checkpoint
+    @stage
     def determine_and_perform_tag_actions(self):
         self._determine_tag_actions()
         self._perform_tag_actions()
@@ -539,21 +848,93 @@ class MasherThread(threading.Thread):
                 self.move_tags.extend(move_tags)
 
     def _perform_tag_actions(self):
-        self.koji.multicall = True
+        actions = []
         for action in self.add_tags:
             tag, build = action
             self.log.info("Adding tag %s to %s" % (tag, build))
-            self.koji.tagBuild(tag, build, force=True)
+            actions.append(('tagBuild', action))
         for action in self.move_tags:
             from_tag, to_tag, build = action
             self.log.info('Moving %s from %s to %s' % (
                           build, from_tag, to_tag))
-            self.koji.moveBuild(from_tag, to_tag, build, force=True)
-        results = self.koji.multiCall()
-        failed_tasks = buildsys.wait_for_tasks([task[0] for task in results], self.koji, sleep=15)
-        if failed_tasks:
-            raise Exception("Failed to move builds: %s" % failed_tasks)
+            actions.append(('moveBuild', action))
+        if not actions:
+            return
 
+        # Submit the chunks from a small pool of workers, each of which
+        # talks to koji over its own session.
+        chunks = self._chunk_tag_actions(actions)
+        pool = ThreadPool(min(len(chunks),
+                              int(config.get('koji_tag_workers', 4))),
+                          self._init_tag_worker, (stats.current(),))
+        try:
+            failed = sum(pool.map(self._perform_tag_chunk, chunks), [])
+        finally:
+            pool.close()
+            pool.join()
+        if failed:
+            raise Exception("Failed to move builds: %s" % failed)
+
+    def _chunk_tag_actions(self, actions):
+        """Split our tag actions into chunks of `koji_tag_chunk_size`.
+
+        All of the actions for a given package are kept in the same chunk, in
+        order, so the latest build still gets tagged last.
+        """
+        size = int(config.get('koji_tag_chunk_size', 100))
+        packages = OrderedDict()
+        for method, args in actions:
+            package = get_nvr(args[-1])[0]
+            packages.setdefault(package, []).append((method, args))
+        chunks, chunk = [], []
+        for package_actions in packages.values():
+            if chunk and len(chunk) + len(package_actions) > size:
+                chunks.append(chunk)
+                chunk = []
+            chunk.extend(package_actions)
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _init_tag_worker(self, counts):
+        """Log a worker of the tag action pool in to koji, once for all of the
+        chunks that it performs"""
+        stats.adopt(counts)
+        self.tag_worker.koji = buildsys.get_session()
+
+    def _perform_tag_chunk(self, chunk):
+        """Perform a chunk of tag actions with a single koji multicall.
+
+        The actions whose tasks fail are retried up to `koji_tag_retries`
+        times, and any that still fail are returned.
+        """
+        koji = self.tag_worker.koji
+        retries = int(config.get('koji_tag_retries', 3))
+        for attempt in range(retries + 1):
+            if attempt:
+                self.log.warn('Retrying %d failed tag actions (attempt %d)',
+                              len(chunk), attempt)
+            koji.multicall = True
+            for method, args in chunk:
+                getattr(koji, method)(*args, force=True)
+            failed, tasks = [], []
+            for action, result in zip(chunk, koji.multiCall()):
+                if isinstance(result, dict):
+                    self.log.error('%s%r failed: %s', action[0], action[1],
+                                   result.get('faultString'))
+                    failed.append(action)
+                else:
+                    tasks.append((result[0], action))
+            failed_tasks = buildsys.wait_for_tasks(
+                [task for task, action in tasks], koji, sleep=15)
+            failed.extend([action for task, action in tasks
+                           if task in failed_tasks])
+            if not failed:
+                return []
+            chunk = failed
+        return [args[-1] for method, args in chunk]
+
+    @stage
     def expire_buildroot_overrides(self):
         """ Expire any buildroot overrides that are in this push """
         for update in self.updates:
@@ -565,6 +946,8 @@ class MasherThread(threading.Thread):
                         except:
                             log.exception('Problem expiring override')
 
+    @checkpoint
+    @stage
     def remove_pending_tags(self):
         """ Remove all pending tags from these updates """
         self.log.debug("Removing pending tags from builds")
@@ -580,6 +963,8 @@ class MasherThread(threading.Thread):
         self.log.debug('remove_pending_tags koji.multiCall result = %r',
                        result)
 
+    @checkpoint
+    @stage
     def update_comps(self):
         """
         Update our comps git module and merge the latest translations so we can
@@ -588,15 +973,45 @@ class MasherThread(threading.Thread):
         self.log.info("Updating comps")
         comps_dir = config.get('comps_dir')
         comps_url = config.get('comps_url')
-        if not os.path.exists(comps_dir):
-            util.cmd(['git', 'clone', comps_url], os.path.dirname(comps_dir))
-        if comps_url.startswith('git://'):
-            util.cmd(['git', 'pull'], comps_dir)
-        else:
-            self.log.error('comps_url must start with git://')
-            return
-        util.cmd(['make'], comps_dir)
+        # Every thread of a push shares the same checkout, so only one of
+        # them may update it at a time.
+        with comps_lock:
+            if not os.path.exists(comps_dir):
+                util.cmd(['git', 'clone', comps_url],
+                         os.path.dirname(comps_dir))
+            if comps_url.startswith('git://'):
+                util.cmd(['git', 'pull'], comps_dir)
+            else:
+                self.log.error('comps_url must start with git://')
+                return
 
+            # Skip the build if the comps we built from this HEAD are intact
+            out, err, returncode = util.cmd(['git', 'rev-parse', 'HEAD'],
+                                            comps_dir)
+            head = returncode == 0 and out.strip()
+            stamp = os.path.join(comps_dir, '.bodhi-comps-stamp')
+            if head and os.path.exists(stamp):
+                with file(stamp) as f:
+                    if f.read() == '%s %s' % (head, self.hash_comps(comps_dir)):
+                        self.log.info('Comps are up to date with %s', head)
+                        return
+
+            util.cmd(['make'], comps_dir)
+            if head:
+                with file(stamp, 'w') as f:
+                    f.write('%s %s' % (head, self.hash_comps(comps_dir)))
+
+    def hash_comps(self, comps_dir):
+        """Return a hash of all of the comps-*.xml files in comps_dir"""
+        checksum = hashlib.sha1()
+        for filename in sorted(glob.glob(os.path.join(comps_dir,
+                                                      'comps-*.xml'))):
+            checksum.update(os.path.basename(filename))
+            with file(filename) as f:
+                checksum.update(f.read())
+        return checksum.hexdigest()
+
+    @stage
     def mash(self):
         if self.path in self.state['completed_repos']:
             self.log.info('Skipping completed repo: %s', self.path)
@@ -606,46 +1021,191 @@ class MasherThread(threading.Thread):
                              self.release.branch)
         previous = os.path.join(config.get('mash_stage_dir'), self.id)
 
-        mash_thread = MashThread(self.id, self.path, comps, previous, self.log)
+        fingerprint = self.fingerprint(comps)
+        with file(os.path.join(self.path, 'mash.fingerprint'), 'w') as f:
+            f.write(fingerprint)
+        if self.reuse_previous_mash(previous, fingerprint):
+            self.state['completed_repos'].append(self.path)
+            self.record_state('append', 'completed_repos', self.path)
+            return
+
+        mash_thread = self.mash_thread = MashThread(self.id, self.path, comps,
+                                                    previous, self.log)
         mash_thread.start()
         return mash_thread
 
+    def fingerprint(self, comps):
+        """Return a fingerprint of what a mash of our tag would contain: the
+        latest builds in the tag and the comps file"""
+        fingerprint = hashlib.sha256()
+        builds = self.koji.listTagged(self.id, latest=True, inherit=True)
+        for nvr in sorted(build['nvr'] for build in builds):
+            fingerprint.update(nvr + '\n')
+        if os.path.exists(comps):
+            with file(comps, 'rb') as f:
+                fingerprint.update(f.read())
+        return fingerprint.hexdigest()
+
+    def reuse_previous_mash(self, previous, fingerprint):
+        """
+        Reuse the previous mash of our tag if nothing in it has changed.
+
+        The previous repo is hardlinked into our mash, apart from its
+        repodata, which is copied so that our updateinfo can be injected
+        into it.  Returns whether the previous mash was reused.
+        """
+        repo = os.path.realpath(previous)
+        stamp = os.path.join(os.path.dirname(repo), 'mash.fingerprint')
+        try:
+            with file(stamp) as f:
+                if f.read().strip() != fingerprint:
+                    return False
+        except IOError:
+            return False
+
+        self.log.info('%s is unchanged since %s, reusing it instead of '
+                      'mashing', self.id, repo)
+        target = os.path.join(self.path, self.id)
+        try:
+            util.hardlink_tree(repo, target, copy=('repodata',))
+        except (OSError, IOError, shutil.Error):
+            self.log.exception('Unable to reuse %s', repo)
+            shutil.rmtree(target, ignore_errors=True)
+            return False
+        return True
+
+    @property
+    def progress(self):
+        """The live progress of our mash, or None if it is not running"""
+        if self.mash_thread is None:
+            return None
+        return self.mash_thread.get_progress()
+
+    @stage
     def wait_for_mash(self, mash_thread):
+        if mash_thread is None:
+            # This repo was already mashed in a previous run
+            return
         self.log.debug('Waiting for mash thread to finish')
-        mash_thread.join()
+        interval = int(config.get('mash_progress_interval', 60))
+        stall_timeout = int(config.get('mash_stall_timeout', 1800))
+        mash_thread.join(interval)
+        while mash_thread.is_alive():
+            progress = mash_thread.get_progress()
+            self.log.info('Mash of %s: %d lines, %d packages, arches: %s',
+                          self.id, progress['lines'], progress['packages'],
+                          ', '.join('%s (%s)' % item for item in
+                                    progress['arches'].items()) or 'none')
+            last_output = progress['last_output'] or progress['started']
+            if last_output and time.time() - last_output > stall_timeout:
+                self.log.warn('mash has printed nothing for %d seconds, it '
+                              'may have stalled: %s', time.time() - last_output,
+                              progress['last_line'])
+            mash_thread.join(interval)
         if mash_thread.success:
             self.state['completed_repos'].append(self.path)
-            self.save_state()
+            self.record_state('append', 'completed_repos', self.path)
         else:
             raise Exception
 
+    @property
+    def updates(self):
+        """
+        The updates of this push, which are loaded again by title if
+        chunk_updates() has let go of them.
+        """
+        if self._updates is None:
+            self._updates = Update.get_by_titles(self.state['updates'],
+                                                 self.db)
+        return self._updates
+
+    @updates.setter
+    def updates(self, updates):
+        self._updates = updates
+
+    def chunk_updates(self):
+        """
+        Yield our updates in chunks of at most `mash_update_chunk_size`.
+
+        Each chunk is loaded from the database in turn.  Once it is done, its
+        changes are flushed and it is expunged from the session, so that
+        memory use depends on the size of a chunk rather than that of the
+        push.  The updates are loaded again by the next stage that needs them.
+        """
+        size = int(config.get('mash_update_chunk_size', 100))
+        titles = list(self.state['updates'])
+        self.db.flush()
+        if self._updates:
+            self.expunge_updates(self._updates)
+        self.updates = None
+        for i in range(0, len(titles), size):
+            chunk = Update.get_by_titles(titles[i:i + size], self.db)
+            yield chunk
+            self.db.flush()
+            self.expunge_updates(chunk)
+
+    def expunge_updates(self, updates):
+        """Expunge updates from the session, along with their builds, bugs
+        and any comments that were loaded"""
+        for update in updates:
+            objects = [update] + update.builds + update.bugs
+            if 'comments' in update.__dict__:
+                objects += update.comments
+            for obj in objects:
+                if obj in self.db:
+                    self.db.expunge(obj)
+
+    @stage
     def complete_requests(self):
         self.log.info("Running post-request actions on updates")
-        for update in self.updates:
-            if update.request:
-                update.request_complete()
-            else:
-                self.log.warn('Update %s missing request', update.title)
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                if update.request:
+                    update.request_complete()
+                else:
+                    self.log.warn('Update %s missing request', update.title)
 
     def add_to_digest(self, update):
-        """Add an package to the digest dictionary.
+        """Spool the digest text of each build of an update to disk.
 
-        {'release-id': {'build nvr': body text for build, ...}}
+        {'release-id': directory holding a file of body text per build nvr}
         """
         prefix = update.release.long_name
         if prefix not in self.testing_digest:
-            self.testing_digest[prefix] = {}
+            self.testing_digest[prefix] = os.path.join(
+                self.path, 'testing-digest', prefix)
+            if not os.path.isdir(self.testing_digest[prefix]):
+                os.makedirs(self.testing_digest[prefix])
         for i, subbody in enumerate(mail.get_template(
                 update, use_template='maillist_template')):
-            self.testing_digest[prefix][update.builds[i].nvr] = subbody[1]
+            spool = os.path.join(self.testing_digest[prefix],
+                                 update.builds[i].nvr)
+            with codecs.open(spool, 'w', encoding='utf-8') as f:
+                f.write(subbody[1])
 
+    def read_digest(self, prefix, nvr):
+        """Return the spooled digest text of a build"""
+        spool = os.path.join(self.testing_digest[prefix], nvr)
+        with codecs.open(spool, encoding='utf-8') as f:
+            return f.read()
+
+    @checkpoint
+    @stage
     def generate_testing_digest(self):
         self.log.info('Generating testing digest for %s' % self.release.name)
-        for update in self.updates:
-            if update.status is UpdateStatus.testing:
-                self.add_to_digest(update)
+        # Start over from anything spooled by an earlier attempt
+        spool = os.path.join(self.path, 'testing-digest')
+        if os.path.isdir(spool):
+            shutil.rmtree(spool)
+        self.testing_digest = {}
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                if update.status is UpdateStatus.testing:
+                    self.add_to_digest(update)
         self.log.info('Testing digest generation for %s complete' % self.release.name)
+        return self.testing_digest
 
+    @stage
     def generate_updateinfo(self):
         self.log.info('Generating updateinfo for %s' % self.release.name)
         uinfo = ExtendedMetadata(self.release, self.request,
@@ -653,6 +1213,16 @@ class MasherThread(threading.Thread):
         self.log.info('Updateinfo generation for %s complete' % self.release.name)
         return uinfo
 
+    @checkpoint
+    @stage
+    def update_repodata(self, uinfo):
+        """Inject the updateinfo and pkgtags into the mashed repodata"""
+        uinfo.insert_updateinfo()
+        uinfo.insert_pkgtags()
+        uinfo.cache_repodata()
+
+    @checkpoint
+    @stage
     def sanity_check_repo(self):
         """Sanity check our repo.
 
@@ -662,15 +1232,25 @@ class MasherThread(threading.Thread):
         mash_path = os.path.join(self.path, self.id)
         self.log.info("Running sanity checks on %s" % mash_path)
 
-        # sanity check our repodata
+        # sanity check the repodata of every arch at once
         arches = os.listdir(mash_path)
-        for arch in arches:
-            try:
-                repodata = os.path.join(mash_path, arch, 'repodata')
-                sanity_check_repodata(repodata)
-            except Exception, e:
-                self.log.error("Repodata sanity check failed!\n%s" % str(e))
-                raise
+        repodata = [os.path.join(mash_path, arch, 'repodata')
+                    for arch in arches]
+        processes = int(config.get('sanity_check_processes',
+                                   multiprocessing.cpu_count()))
+        pool = multiprocessing.Pool(max(min(processes, len(arches)), 1))
+        try:
+            for path in pool.imap_unordered(_sanity_check_arch, repodata):
+                self.log.debug('Repodata sanity check passed: %s', path)
+        except Exception, e:
+            # There is no point in checking the other arches
+            pool.terminate()
+            self.log.error("Repodata sanity check failed!\n%s" % str(e))
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
 
         # make sure that mash didn't symlink our packages
         for pkg in os.listdir(os.path.join(mash_path, arches[0])):
@@ -682,6 +1262,8 @@ class MasherThread(threading.Thread):
 
         return True
 
+    @checkpoint
+    @stage
     def stage_repo(self):
         """Symlink our updates repository into the staging directory"""
         stage_dir = config.get('mash_stage_dir')
@@ -694,16 +1276,23 @@ class MasherThread(threading.Thread):
         self.log.info("Creating symlink: %s => %s" % (self.path, link))
         os.symlink(os.path.join(self.path, self.id), link)
 
+    @checkpoint
+    @stage
     def wait_for_sync(self):
-        """Block until our repomd.xml hits the master mirror"""
+        """
+        Block until our repomd.xml hits the master mirror for every arch.
+
+        Each arch is watched in its own thread, and the number of seconds
+        that it took to sync is returned so that mirror lag can be tracked.
+        """
         self.log.info('Waiting for updates to hit the master mirror')
         notifications.publish(
             topic="mashtask.sync.wait",
             msg=dict(repo=self.id),
             force=True,
         )
+        start = time.time()
         mash_path = os.path.join(self.path, self.id)
-        arch = os.listdir(mash_path)[0]
 
         release = self.release.id_prefix.lower().replace('-', '_')
         request = self.request.value
@@ -712,69 +1301,129 @@ class MasherThread(threading.Thread):
         if not master_repomd:
             raise ValueError("Could not find %s in the config file" % key)
 
-        repomd = os.path.join(mash_path, arch, 'repodata', 'repomd.xml')
-        if not os.path.exists(repomd):
-            self.log.error('Cannot find local repomd: %s', repomd)
+        arches = []
+        for arch in sorted(os.listdir(mash_path)):
+            repomd = os.path.join(mash_path, arch, 'repodata', 'repomd.xml')
+            if not os.path.isdir(os.path.join(mash_path, arch)):
+                continue
+            if not os.path.exists(repomd):
+                self.log.error('Cannot find local repomd: %s', repomd)
+                continue
+            checksum = hashlib.sha1(file(repomd).read()).hexdigest()
+            url = master_repomd % (self.release.version, arch)
+            arches.append((arch, url, checksum, start))
+        if not arches:
             return
 
-        checksum = hashlib.sha1(file(repomd).read()).hexdigest()
+        pool = ThreadPool(len(arches), stats.adopt, (stats.current(),))
+        try:
+            sync_times = dict(pool.map(self._wait_for_arch_sync, arches))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.log.info("master repomd.xml matches for every arch!")
+        notifications.publish(
+            topic="mashtask.sync.done",
+            msg=dict(repo=self.id, sync_times=sync_times),
+            force=True,
+        )
+        return sync_times
+
+    def _wait_for_arch_sync(self, args):
+        """
+        Poll the master mirror until it serves our repomd.xml for one arch.
+
+        Conditional requests are used so that an unchanged repomd.xml is not
+        downloaded again.  The polling interval doubles while the mirror is
+        idle or unreachable, up to `wait_for_sync_max_interval`, and drops back
+        to `wait_for_sync_min_interval` as soon as the mirror changes.
+        """
+        arch, url, checksum, start = args
+        min_interval = int(config.get('wait_for_sync_min_interval', 10))
+        max_interval = int(config.get('wait_for_sync_max_interval', 200))
+        interval = min_interval
+        headers = {}
         while True:
+            self.log.info('Polling %s' % url)
             try:
-                url = master_repomd % (self.release.version, arch)
-                self.log.info('Polling %s' % url)
-                masterrepomd = urllib2.urlopen(url)
-            except (urllib2.URLError, urllib2.HTTPError):
+                response = urllib2.urlopen(urllib2.Request(url, headers=headers),
+                                           timeout=60)
+                newsum = hashlib.sha1(response.read()).hexdigest()
+            except urllib2.HTTPError as e:
+                if e.code == 304:
+                    self.log.debug('%s has not been modified', url)
+                else:
+                    self.log.exception('Error fetching repomd.xml')
+                interval = min(interval * 2, max_interval)
+            except urllib2.URLError:
                 self.log.exception('Error fetching repomd.xml')
-                time.sleep(200)
-                continue
-            newsum = hashlib.sha1(masterrepomd.read()).hexdigest()
-            if newsum == checksum:
-                self.log.info("master repomd.xml matches!")
-                notifications.publish(
-                    topic="mashtask.sync.done",
-                    msg=dict(repo=self.id),
-                    force=True,
-                )
-                return
-
-            self.log.debug("master repomd.xml doesn't match! %s != %s for %r",
-                           checksum, newsum, self.id)
-            time.sleep(200)
+                interval = min(interval * 2, max_interval)
+            else:
+                if newsum == checksum:
+                    elapsed = time.time() - start
+                    self.log.info("master repomd.xml for %s matches after "
+                                  "%d seconds", arch, elapsed)
+                    return arch, elapsed
+
+                self.log.debug("master repomd.xml doesn't match! %s != %s "
+                               "for %r %s", checksum, newsum, self.id, arch)
+                # Only download it again once the mirror has changed
+                info = response.info()
+                headers = {}
+                if info.get('ETag'):
+                    headers['If-None-Match'] = info.get('ETag')
+                if info.get('Last-Modified'):
+                    headers['If-Modified-Since'] = info.get('Last-Modified')
+                interval = min_interval
+            time.sleep(interval)
 
+    @checkpoint
+    @stage
     def send_notifications(self):
         self.log.info('Sending notifications')
         try:
             agent = os.getlogin()
         except OSError:  # this can happen when building on koji
             agent = u'masher'
-        for update in self.updates:
-            topic = u'update.complete.%s' % update.status
-            notifications.publish(
-                topic=topic,
-                msg=dict(update=update, agent=agent),
-                force=True,
-            )
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                topic = u'update.complete.%s' % update.status
+                notifications.publish(
+                    topic=topic,
+                    msg=dict(update=update, agent=agent),
+                    force=True,
+                )
 
     @checkpoint
+    @stage
     def modify_bugs(self):
         self.log.info('Updating bugs')
-        for update in self.updates:
-            self.log.debug('Modifying bugs for %s', update.title)
-            update.modify_bugs()
-
+        queue = BugWorkQueue()
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                self.log.debug('Modifying bugs for %s', update.title)
+                update.modify_bugs(tracker=queue)
+        queue.join()
+
+    @stage
     def status_comments(self):
         self.log.info('Commenting on updates')
-        for update in self.updates:
-            update.status_comment()
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                update.status_comment()
 
     @checkpoint
+    @stage
     def send_stable_announcements(self):
         self.log.info('Sending stable update announcements')
-        for update in self.updates:
-            if update.status is UpdateStatus.stable:
-                update.send_update_notice()
+        for chunk in self.chunk_updates():
+            for update in chunk:
+                if update.status is UpdateStatus.stable:
+                    update.send_update_notice()
 
     @checkpoint
+    @stage
     def send_testing_digest(self):
         """Send digest mail to mailing lists"""
         self.log.info('Sending updates-testing digest')
@@ -815,13 +1464,12 @@ class MasherThread(threading.Thread):
                 maildata += '\n\n'
 
             maildata += testhead % prefix
-            updlist = content.keys()
-            updlist.sort()
+            updlist = sorted(os.listdir(content))
             for pkg in updlist:
                 maildata += u'    %s\n' % pkg
             maildata += u'\nDetails about builds:\n\n'
             for nvr in updlist:
-                maildata += u"\n" + self.testing_digest[prefix][nvr]
+                maildata += u"\n" + self.read_digest(prefix, nvr)
 
             mail.send_mail(config.get('bodhi_email'), test_list,
                            '%s updates-testing report' % prefix, maildata)
@@ -854,14 +1502,21 @@ class MasherThread(threading.Thread):
         return updates
 
     @checkpoint
+    @stage
     def compose_atomic_trees(self):
-        """Compose Atomic OSTrees for each tag that we mashed"""
-        from fedmsg_atomic_composer.composer import AtomicComposer
+        """
+        Compose Atomic OSTrees for each tag that we mashed.
+
+        The trees of different tags are composed at once, by at most
+        `max_concurrent_composes` workers.  Every compose runs even if
+        another one fails, and the result and time of each compose are
+        returned by tag.
+        """
         from fedmsg_atomic_composer.config import config as atomic_config
 
-        composer = AtomicComposer()
         mashed_repos = dict([('-'.join(os.path.basename(repo).split('-')[:-1]), repo)
                              for repo in self.state['completed_repos']])
+        releases = []
         for tag, mash_path in mashed_repos.items():
             if tag not in atomic_config['releases']:
                 log.warn('Cannot find atomic configuration for %r', tag)
@@ -882,37 +1537,124 @@ class MasherThread(threading.Thread):
                           release['repos']['updates'])
             else:
                 release['repos']['updates'] = mash_path
+            releases.append((tag, release))
 
-            # Compose the tree, and raise an exception upon failure
-            result = composer.compose(release)
-            if result['result'] != 'success':
-                self.log.error(result)
-                raise Exception('%s atomic compose failed' % tag)
-            else:
-                self.log.info('%s atomic tree compose successful', tag)
+        if not releases:
+            return
+
+        pool = ThreadPool(min(len(releases),
+                              int(config.get('max_concurrent_composes', 2))),
+                          stats.adopt, (stats.current(),))
+        try:
+            results = dict(pool.map(self._compose_atomic_tree, releases))
+        finally:
+            pool.close()
+            pool.join()
+
+        failed = sorted(tag for tag, result in results.items()
+                        if result['result'] != 'success')
+        if failed:
+            raise Exception('%s atomic compose failed' % ', '.join(failed))
+        return results
+
+    def _compose_atomic_tree(self, args):
+        """Compose the tree of one tag, returning its result and duration"""
+        from fedmsg_atomic_composer.composer import AtomicComposer
+
+        tag, release = args
+        start = time.time()
+        try:
+            result = AtomicComposer().compose(release)
+        except Exception, e:
+            self.log.exception('%s atomic compose failed', tag)
+            result = dict(result='failed', error=str(e))
+        duration = time.time() - start
+        if result['result'] == 'success':
+            self.log.info('%s atomic tree compose successful (%d seconds)',
+                          tag, duration)
+        else:
+            self.log.error('%s atomic compose failed after %d seconds',
+                           tag, duration)
+            self.log.error(result)
+        return tag, dict(result=result['result'], time=duration)
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Renew the lease on a repo every `interval` seconds until stopped"""
+
+    def __init__(self, session_factory, tag, owner, interval, log):
+        super(LeaseHeartbeat, self).__init__()
+        self.daemon = True
+        self.session_factory = session_factory
+        self.tag = tag
+        self.owner = owner
+        self.interval = interval
+        self.log = log
+        self.lost = False
+        self.stopped = threading.Event()
+        self.name = '%s-lease' % tag
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            session = self.session_factory()
+            try:
+                if not RepoLease.renew(session, self.tag, self.owner):
+                    self.log.error('Lost the lease on %s to %s', self.tag,
+                                   RepoLease.holder(session, self.tag))
+                    self.lost = True
+                    return
+            except Exception:
+                # It may be renewed in time on the next try
+                self.log.exception('Unable to renew the lease on %s', self.tag)
+            finally:
+                session.close()
+
+    def stop(self):
+        self.stopped.set()
+
+
+def _sanity_check_arch(repodata):
+    """Sanity check the repodata of one arch, in a worker process"""
+    sanity_check_repodata(repodata)
+    return repodata
 
 
 class MashThread(threading.Thread):
 
+    # The markers that mash prints as it works through a repo
+    createrepo_re = re.compile(r'Running createrepo on (\S+?)\.*$')
+    packages_re = re.compile(r'\b(\d+) (?:packages|pkgs)\b', re.IGNORECASE)
+
     def __init__(self, tag, outputdir, comps, previous, log):
         super(MashThread, self).__init__()
         self.tag = tag
         self.log = log
         self.success = False
+        self.repo_dir = os.path.join(outputdir, tag)
         mash_cmd = 'mash -o {outputdir} -c {config} -f {compsfile} {tag}'
         mash_conf = config.get('mash_conf', '/etc/mash/mash.conf')
         if os.path.exists(previous):
             mash_cmd += ' -p {}'.format(previous)
         self.mash_cmd = mash_cmd.format(outputdir=outputdir, config=mash_conf,
                                         compsfile=comps, tag=self.tag).split()
+        self.progress_lock = threading.Lock()
+        self.progress = {
+            'started': None,
+            'lines': 0,
+            'last_line': None,
+            'last_output': None,
+            'packages': 0,
+            'arches': OrderedDict(),
+        }
         # Set our thread's "name" so it shows up nicely in the logs.
         # https://docs.python.org/2/library/threading.html#thread-objects
         self.name = tag
 
     def run(self):
-        start = time.time()
+        start = self.progress['started'] = time.time()
         self.log.info('Mashing %s', self.tag)
-        out, err, returncode = util.cmd(self.mash_cmd)
+        out, err, returncode = util.cmd(self.mash_cmd,
+                                        line_callback=self.parse_line)
         self.log.info('Took %s seconds to mash %s', time.time() - start,
                  self.tag)
         if returncode != 0:
@@ -923,3 +1665,45 @@ class MashThread(threading.Thread):
         else:
             self.success = True
         return out, err, returncode
+
+    def parse_line(self, line):
+        """Log a line of mash output, and update our progress from it"""
+        self.log.debug('mash: %s', line)
+        with self.progress_lock:
+            progress = self.progress
+            progress['lines'] += 1
+            progress['last_line'] = line
+            progress['last_output'] = time.time()
+            match = self.createrepo_re.search(line)
+            if match:
+                arch = self.get_arch(match.group(1))
+                if arch:
+                    progress['arches'][arch] = 'createrepo'
+            match = self.packages_re.search(line)
+            if match:
+                progress['packages'] = max(progress['packages'],
+                                           int(match.group(1)))
+
+    def get_arch(self, path):
+        """Return the arch of a path within our repo, if any"""
+        path = os.path.relpath(os.path.normpath(path), self.repo_dir)
+        if path.startswith(os.pardir) or path == os.curdir:
+            return None
+        return path.split(os.sep)[0]
+
+    def get_progress(self):
+        """
+        Return a snapshot of the progress of this mash.
+
+        An arch is done once its repomd.xml has been written, which covers the
+        arches that finish without us seeing their createrepo marker.
+        """
+        with self.progress_lock:
+            progress = copy.deepcopy(self.progress)
+        if os.path.isdir(self.repo_dir):
+            for arch in sorted(os.listdir(self.repo_dir)):
+                repomd = os.path.join(self.repo_dir, arch, 'repodata',
+                                      'repomd.xml')
+                if os.path.exists(repomd):
+                    progress['arches'][arch] = 'done'
+        return progress
@@ -19,17 +19,113 @@ import logging
 import shutil
 import tempfile
 
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
 from urlgrabber.grabber import urlgrab
 from kitchen.text.converters import to_bytes
 
 import createrepo_c as cr
 
 from bodhi.config import config
-from bodhi.models import Build, UpdateStatus, UpdateRequest, UpdateSuggestion
-from bodhi.buildsys import get_session
+from bodhi.models import (Update, UpdateStatus, UpdateRequest,
+                          UpdateSuggestion)
+from bodhi.buildsys import get_session, chunked_multicall
+from bodhi.util import build_rpms_cache, koji_build_cache, LRUCache
 
 log = logging.getLogger(__name__)
 
+## The notices of updates, keyed by notice_key().  A notice never changes for
+## a given key, so they may also be kept on disk in notice_cache_dir, where
+## they outlive the cached repodata of the repos.  The current key of each
+## update is kept under its alias, so that its outdated notice can be removed.
+notice_cache = LRUCache(int(config.get('notice_cache_size', 5000)),
+                        config.get('notice_cache_dir'))
+
+_notice_fields = ('id', 'title', 'fromstr', 'status', 'type', 'version',
+                  'release', 'rights', 'summary', 'description')
+_collection_fields = ('name', 'shortname')
+_package_fields = ('name', 'version', 'release', 'epoch', 'arch', 'src',
+                   'filename', 'reboot_suggested')
+_reference_fields = ('href', 'id', 'type', 'title')
+
+
+def _dump(obj, fields):
+    return dict((field, getattr(obj, field)) for field in fields)
+
+
+def _load(obj, data, fields):
+    for field in fields:
+        value = data.get(field)
+        if isinstance(value, unicode):
+            value = to_bytes(value)
+        if value is not None:
+            setattr(obj, field, value)
+    return obj
+
+
+def _dump_date(date):
+    return date and list(date.timetuple()[:6]) + [date.microsecond]
+
+
+def notice_to_dict(rec):
+    """Serialize an UpdateRecord, with its collections and references, into
+    a dict that can be stored as JSON"""
+    data = _dump(rec, _notice_fields)
+    data['issued_date'] = _dump_date(rec.issued_date)
+    data['updated_date'] = _dump_date(rec.updated_date)
+    data['collections'] = []
+    for col in rec.collections:
+        collection = _dump(col, _collection_fields)
+        collection['packages'] = [_dump(pkg, _package_fields)
+                                  for pkg in col.packages]
+        data['collections'].append(collection)
+    data['references'] = [_dump(ref, _reference_fields)
+                          for ref in rec.references]
+    return data
+
+
+def notice_from_dict(data):
+    """Make an UpdateRecord out of a dict made by notice_to_dict()"""
+    rec = _load(cr.UpdateRecord(), data, _notice_fields)
+    for field in ('issued_date', 'updated_date'):
+        if data.get(field):
+            setattr(rec, field, datetime(*data[field]))
+    for collection in data['collections']:
+        col = _load(cr.UpdateCollection(), collection, _collection_fields)
+        for package in collection['packages']:
+            col.append(_load(cr.UpdateCollectionPackage(), package,
+                             _package_fields))
+        rec.append_collection(col)
+    for reference in data['references']:
+        rec.append_reference(_load(cr.UpdateReference(), reference,
+                                   _reference_fields))
+    return rec
+
+
+def notice_key(update):
+    """
+    The key of the notice of an update in the notice_cache.
+
+    Besides being edited, which bumps its date_modified, the notice of an
+    update also changes when it is pushed, so its status and push date are
+    part of the key too.
+    """
+    return '%s %s %s %s' % (update.alias, update.status.value,
+                            update.date_modified and
+                            update.date_modified.isoformat(),
+                            update.date_pushed and
+                            update.date_pushed.isoformat())
+
+
+def store_notice(update, rec):
+    """Store the notice of an update, replacing any outdated one"""
+    key = notice_key(update)
+    previous = notice_cache.get(update.alias)
+    if previous is not None and previous != key:
+        notice_cache.delete(previous)
+    notice_cache.set(key, notice_to_dict(rec))
+    notice_cache.set(update.alias, key)
+
 
 class ExtendedMetadata(object):
     """This class represents the updateinfo.xml yum metadata.
@@ -80,11 +176,13 @@ class ExtendedMetadata(object):
         else:
             log.debug("Generating new updateinfo.xml")
             self.uinfo = cr.UpdateInfo()
+            new = []
             for update in self.updates:
                 if update.alias:
-                    self.add_update(update)
+                    new.append(update)
                 else:
                     self.missing_ids.append(update.title)
+            self.add_updates(new)
 
         if self.missing_ids:
             log.error("%d updates with missing ID!" % len(self.missing_ids))
@@ -96,7 +194,7 @@ class ExtendedMetadata(object):
         """
         seen_ids = set()
         from_cache = set()
-        existing_ids = set()
+        new = []
 
         # Parse the updateinfo out of the repomd
         updateinfo = None
@@ -116,9 +214,13 @@ class ExtendedMetadata(object):
         log.info('Loading cached updateinfo: %s', updateinfo)
         uinfo = cr.UpdateInfo(updateinfo)
 
-        # Determine which updates are present in the cache
-        for update in uinfo.updates:
-            existing_ids.add(update.id)
+        # Index the cached notices by id and by title in one pass
+        notices = uinfo.updates
+        notices_by_id = {}
+        notices_by_title = {}
+        for notice in notices:
+            notices_by_id[notice.id] = notice
+            notices_by_title[notice.title] = notice
 
         # Generate metadata for any new builds
         for update in self.updates:
@@ -126,70 +228,125 @@ class ExtendedMetadata(object):
             if not update.alias:
                 self.missing_ids.append(update.title)
                 continue
-            if update.alias in existing_ids:
-                notice = None
-                for value in uinfo.updates:
-                    if value.title == update.title:
-                        notice = value
-                        break
+            if update.alias in notices_by_id:
+                notice = notices_by_title.get(update.title)
                 if not notice:
                     log.warn('%s ID in cache but notice cannot be found', update.title)
-                    self.add_update(update)
+                    new.append(update)
                     continue
                 if notice.updated_date:
                     if notice.updated_date < update.date_modified:
                         log.debug('Update modified, generating new notice: %s' % update.title)
-                        self.add_update(update)
+                        new.append(update)
                     else:
                         log.debug('Loading updated %s from cache' % update.title)
                         from_cache.add(update.alias)
                 elif update.date_modified:
                     log.debug('Update modified, generating new notice: %s' % update.title)
-                    self.add_update(update)
+                    new.append(update)
                 else:
                     log.debug('Loading %s from cache' % update.title)
                     from_cache.add(update.alias)
             else:
                 log.debug('Adding new update notice: %s' % update.title)
-                self.add_update(update)
-
-        # Add all relevant notices from the cache to this document
-        for notice in uinfo.updates:
-            if notice.id in from_cache:
+                new.append(update)
+
+        self.add_updates(new)
+
+        # Add all relevant notices from the cache to this document.  The stable
+        # repo also keeps every security notice that we did not regenerate.
+        keep = from_cache
+        if self.request is not UpdateRequest.testing:
+            security_ids = set(notice.id for notice in notices
+                               if notice.type == 'security')
+            keep = keep | (security_ids - seen_ids)
+        for notice in notices:
+            if notice.id in keep:
                 log.debug('Keeping existing notice: %s', notice.title)
                 self.uinfo.append(notice)
             else:
-                # Keep all security notices in the stable repo
-                if self.request is not UpdateRequest.testing:
-                    if notice.type == 'security':
-                        if notice.id not in seen_ids:
-                            log.debug('Keeping existing security notice: %s',
-                                      notice.title)
-                            self.uinfo.append(notice)
-                        else:
-                            log.debug('%s already added?', notice.title)
-                    else:
-                        log.debug('Purging cached stable notice %s', notice.title)
-                else:
-                    log.debug('Purging cached testing update %s', notice.title)
+                log.debug('Purging cached notice %s', notice.title)
 
     def _fetch_updates(self):
         """Based on our given koji tag, populate a list of Update objects"""
         log.debug("Fetching builds tagged with '%s'" % self.tag)
         kojiBuilds = self.koji.listTagged(self.tag, latest=True)
-        nonexistent = []
         log.debug("%d builds found" % len(kojiBuilds))
         for build in kojiBuilds:
             self.builds[build['nvr']] = build
-            build_obj = self.db.query(Build).filter_by(nvr=unicode(build['nvr'])).first()
-            if build_obj:
-                self.updates.add(build_obj.update)
-            else:
-                nonexistent.append(build['nvr'])
+        updates = Update.get_by_build_nvrs(
+            self.builds, self.db,
+            int(config.get('updateinfo_query_chunk_size', 500)))
+        self.updates.update(updates.values())
+        nonexistent = sorted(set(self.builds) - set(updates))
         if nonexistent:
             log.warning("Couldn't find the following koji builds tagged as "
                         "%s in bodhi: %s" % (self.tag, nonexistent))
 
+    def add_updates(self, updates):
+        """
+        Add the notices of many updates.
+
+        The stored notices of the updates that have not changed since they
+        were made are reused.  The others are generated, with the RPMs of all
+        of them fetched from koji at once.
+        """
+        stored = {}
+        missing = []
+        for update in updates:
+            notice = notice_cache.get(notice_key(update))
+            if notice is None:
+                missing.append(update)
+            else:
+                stored[update.alias] = notice
+        log.debug('%d stored notices, %d to generate', len(stored),
+                  len(missing))
+
+        self.prefetch_rpms(missing)
+        for update in updates:
+            if update.alias in stored:
+                log.debug('Loading stored notice: %s', update.title)
+                self.uinfo.append(notice_from_dict(stored[update.alias]))
+            else:
+                self.add_update(update)
+
+    def prefetch_rpms(self, updates):
+        """
+        Fetch the koji builds and RPM lists of the builds of many updates with
+        chunked multicalls, before their notices are made.
+
+        The RPMs of a build never change, so they are cached by build id.
+        """
+        chunk_size = int(config.get('koji_multicall_chunk_size', 250))
+        builds = [build for update in updates for build in update.builds]
+
+        nvrs = set()
+        for build in builds:
+            if build.nvr in self.builds:
+                continue
+            kojiBuild = koji_build_cache.get(build.nvr)
+            if kojiBuild:
+                self.builds[build.nvr] = kojiBuild
+            else:
+                nvrs.add(build.nvr)
+        nvrs = sorted(nvrs)
+        results = chunked_multicall(self.koji, 'getBuild',
+                                    [(nvr,) for nvr in nvrs], chunk_size)
+        for nvr, result in zip(nvrs, results):
+            if result:
+                self.builds[nvr] = result
+                koji_build_cache.set(nvr, result)
+
+        ids = sorted(set(self.builds[build.nvr]['id'] for build in builds
+                         if build.nvr in self.builds))
+        ids = [build_id for build_id in ids if build_id not in build_rpms_cache]
+        results = chunked_multicall(self.koji, 'listBuildRPMs',
+                                    [(build_id,) for build_id in ids],
+                                    chunk_size)
+        for build_id, result in zip(ids, results):
+            if result is not None:
+                build_rpms_cache.set(build_id, result)
+
     def add_update(self, update):
         """Generate the extended metadata for a given update"""
         rec = cr.UpdateRecord()
@@ -215,12 +372,14 @@ class ExtendedMetadata(object):
         col.shortname = to_bytes(update.release.name)
 
         for build in update.builds:
-            try:
-                kojiBuild = self.builds[build.nvr]
-            except:
+            kojiBuild = self.builds.get(build.nvr)
+            if kojiBuild is None:
                 kojiBuild = self.koji.getBuild(build.nvr)
 
-            rpms = self.koji.listBuildRPMs(kojiBuild['id'])
+            rpms = build_rpms_cache.get(kojiBuild['id'])
+            if rpms is None:
+                rpms = self.koji.listBuildRPMs(kojiBuild['id'])
+                build_rpms_cache.set(kojiBuild['id'], rpms)
             for rpm in rpms:
                 pkg = cr.UpdateCollectionPackage()
                 pkg.name = rpm['name']
@@ -271,32 +430,73 @@ class ExtendedMetadata(object):
             ref.href = to_bytes(cve.url)
             rec.append_reference(ref)
 
+        store_notice(update, rec)
         self.uinfo.append(rec)
 
     def insert_updateinfo(self):
-        fd, name = tempfile.mkstemp()
+        fd, name = tempfile.mkstemp(suffix='.xml')
         os.write(fd, self.uinfo.xml_dump())
         os.close(fd)
         self.modifyrepo(name)
         os.unlink(name)
 
-    def modifyrepo(self, filename):
-        """Inject a file into the repodata for each architecture"""
-        for arch in os.listdir(self.repo_path):
-            repodata = os.path.join(self.repo_path, arch, 'repodata')
-            log.info('Inserting %s into %s', filename, repodata)
-            uinfo_xml = os.path.join(repodata, 'updateinfo.xml')
-            shutil.copyfile(filename, uinfo_xml)
-            repomd_xml = os.path.join(repodata, 'repomd.xml')
-            repomd = cr.Repomd(repomd_xml)
-            uinfo_rec = cr.RepomdRecord('updateinfo', uinfo_xml)
-            uinfo_rec_comp = uinfo_rec.compress_and_fill(self.hash_type, self.comp_type)
-            uinfo_rec_comp.rename_file()
-            uinfo_rec_comp.type = 'updateinfo'
-            repomd.set_record(uinfo_rec_comp)
-            with file(repomd_xml, 'w') as repomd_file:
-                repomd_file.write(repomd.xml_dump())
-            os.unlink(uinfo_xml)
+    def modifyrepo(self, filename, mdtype='updateinfo'):
+        """
+        Inject a file into the repodata for each architecture.
+
+        The file is compressed and checksummed only once, and then hardlinked
+        into the repodata of every arch, whose repomd.xml files are rewritten
+        concurrently.
+        """
+        scratch = tempfile.mkdtemp('bodhi', dir=self.repo)
+        try:
+            md_file = os.path.join(scratch, mdtype +
+                                   os.path.splitext(filename)[1])
+            shutil.copyfile(filename, md_file)
+            md_rec = cr.RepomdRecord(mdtype, md_file)
+            md_rec_comp = md_rec.compress_and_fill(self.hash_type,
+                                                   self.comp_type)
+            md_rec_comp.rename_file()
+            md_rec_comp.type = mdtype
+
+            arches = os.listdir(self.repo_path)
+            workers = int(config.get('modifyrepo_workers', 8))
+            pool = ThreadPool(max(min(len(arches), workers), 1))
+            try:
+                pool.map(self._inject_record,
+                         [(arch, md_rec_comp.copy()) for arch in arches])
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            shutil.rmtree(scratch)
+
+    def _inject_record(self, args):
+        """
+        Add a compressed metadata record to the repodata of an arch, and
+        remove the file of the record of the same type that it replaces.
+        """
+        arch, record = args
+        repodata = os.path.join(self.repo_path, arch, 'repodata')
+        log.info('Inserting %s into %s', record.type, repodata)
+        target = os.path.join(repodata,
+                              os.path.basename(record.location_real))
+        try:
+            os.link(record.location_real, target)
+        except OSError:
+            shutil.copyfile(record.location_real, target)
+        repomd_xml = os.path.join(repodata, 'repomd.xml')
+        repomd = cr.Repomd(repomd_xml)
+        replaced = [os.path.basename(rec.location_href)
+                    for rec in repomd.records if rec.type == record.type]
+        repomd.set_record(record)
+        with file(repomd_xml, 'w') as repomd_file:
+            repomd_file.write(repomd.xml_dump())
+        for name in replaced:
+            old = os.path.join(repodata, name)
+            if old != target and os.path.exists(old):
+                log.debug('Removing the replaced %s', old)
+                os.unlink(old)
 
     def insert_pkgtags(self):
         """Download and inject the pkgtags sqlite from fedora-tagger"""
@@ -307,7 +507,7 @@ class ExtendedMetadata(object):
                 local_tags = os.path.join(tempdir, 'pkgtags.sqlite')
                 log.info('Downloading %s' % tags_url)
                 urlgrab(tags_url, filename=local_tags)
-                self.modifyrepo(local_tags)
+                self.modifyrepo(local_tags, 'pkgtags')
             except:
                 log.exception("There was a problem injecting pkgtags")
             finally:
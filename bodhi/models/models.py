@@ -21,8 +21,9 @@ import json
 import time
 
 from textwrap import wrap
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import defaultdict
+from multiprocessing.pool import ThreadPool
 
 try:
     # python3
@@ -37,9 +38,11 @@ from sqlalchemy import Table, Column, ForeignKey
 from sqlalchemy import and_, or_
 from sqlalchemy.orm import scoped_session, sessionmaker, relationship, backref
 from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import joinedload, lazyload, subqueryload
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.exc import IntegrityError
 from zope.sqlalchemy import ZopeTransactionExtension
 from pyramid.settings import asbool
 
@@ -492,6 +495,80 @@ class Build(Base):
 
     release = relationship('Release', backref='builds', lazy=False)
 
+    # The koji tags of this build, when prefetched by prefetch_tags()
+    _tags = None
+
+    @classmethod
+    def prefetch_tags(cls, builds, koji=None):
+        """
+        Look up the koji tags of many builds with chunked multicalls, so that
+        get_tags() can answer from memory rather than asking koji per build.
+
+        The tags of builds that could not be looked up are forgotten, so that
+        get_tags() asks koji for them again rather than trusting stale ones.
+        """
+        if not koji:
+            koji = buildsys.get_session()
+        builds = list(builds)
+        chunk_size = int(config.get('koji_multicall_chunk_size', 250))
+        results = buildsys.chunked_multicall(
+            koji, 'listTags', [(build.nvr,) for build in builds], chunk_size)
+        for build, tags in zip(builds, results):
+            if tags is None:
+                build._tags = None
+            else:
+                build._tags = [tag['name'] for tag in tags]
+
+    @classmethod
+    def prefetch_headers(cls, builds, koji=None):
+        """
+        Warm the caches used by get_latest() and get_rpm_header() for many
+        builds with chunked multicalls, before their update notices are made.
+        """
+        if not koji:
+            koji = buildsys.get_session()
+        builds = list(builds)
+        chunk_size = int(config.get('koji_multicall_chunk_size', 250))
+
+        nvrs = [build.nvr for build in builds
+                if build.nvr not in bodhi.util.koji_build_cache]
+        results = buildsys.chunked_multicall(
+            koji, 'getBuild', [(nvr,) for nvr in nvrs], chunk_size)
+        for nvr, result in zip(nvrs, results):
+            if result:
+                bodhi.util.koji_build_cache.set(nvr, result)
+
+        # The latest builds change with every push, so always refresh them
+        keys = set()
+        for build in builds:
+            for tag in (build.update.release.stable_tag,
+                        build.update.release.dist_tag):
+                keys.add((tag, build.package.name))
+        keys = sorted(keys)
+        results = buildsys.chunked_multicall(
+            koji, 'getLatestBuilds',
+            [dict(tag=tag, package=package) for tag, package in keys],
+            chunk_size)
+        for key, result in zip(keys, results):
+            if result is not None:
+                bodhi.util.latest_builds_cache.set(key, result)
+
+        nvrs = set()
+        for build in builds:
+            nvrs.add(build.nvr)
+            latest = build.get_latest()
+            if latest:
+                nvrs.add(latest)
+        nvrs = sorted(nvr for nvr in nvrs
+                      if nvr not in bodhi.util.rpm_header_cache)
+        results = buildsys.chunked_multicall(
+            koji, 'getRPMHeaders',
+            [dict(rpmID=nvr + '.src', headers=bodhi.util.rpm_headers)
+             for nvr in nvrs], chunk_size)
+        for nvr, result in zip(nvrs, results):
+            if result:
+                bodhi.util.rpm_header_cache.set(nvr, result)
+
     def get_latest(self):
         koji_session = buildsys.get_session()
 
@@ -503,9 +580,17 @@ class Build(Base):
         # packages that never make their way over stable, so we don't want to
         # generate ChangeLogs against those.
         latest = None
-        evr = build_evr(koji_session.getBuild(self.nvr))
+        kojiBuild = bodhi.util.koji_build_cache.get(self.nvr)
+        if kojiBuild is None:
+            kojiBuild = koji_session.getBuild(self.nvr)
+            if kojiBuild:
+                bodhi.util.koji_build_cache.set(self.nvr, kojiBuild)
+        evr = build_evr(kojiBuild)
         for tag in [self.update.release.stable_tag, self.update.release.dist_tag]:
-            builds = koji_session.getLatestBuilds(
+            builds = bodhi.util.latest_builds_cache.get(
+                (tag, self.package.name))
+            if builds is None:
+                builds = koji_session.getLatestBuilds(
                     tag, package=self.package.name)
 
             # Find the first build that is older than us
@@ -549,10 +634,17 @@ class Build(Base):
 
     def get_tags(self, koji=None):
         """ Return a list of koji tags for this build """
+        if self._tags is not None:
+            return list(self._tags)
         if not koji:
             koji = buildsys.get_session()
         return [tag['name'] for tag in koji.listTags(self.nvr)]
 
+    def forget_tag(self, tag):
+        """ Drop a tag that was just removed from our prefetched tags """
+        if self._tags is not None and tag in self._tags:
+            self._tags.remove(tag)
+
     def untag(self, koji):
         """Remove all known tags from this build"""
         tag_types, tag_rels = Release.get_tags()
@@ -560,6 +652,7 @@ class Build(Base):
             if tag in tag_rels:
                 log.info('Removing %s tag from %s' % (tag, self.nvr))
                 koji.untagBuild(tag, self.nvr)
+                self.forget_tag(tag)
 
     def unpush(self, koji):
         """
@@ -579,6 +672,18 @@ class Build(Base):
                     release.candidate_tag))
                 koji.moveBuild(tag, release.candidate_tag, self.nvr)
 
+class TaskotronResults(defaultdict):
+    """
+    Taskotron results indexed by (update title, testcase), then by arch,
+    latest first, along with the reason that the results of any update could
+    not be fetched.
+    """
+
+    def __init__(self):
+        super(TaskotronResults, self).__init__(lambda: defaultdict(list))
+        self.errors = {}
+
+
 class Update(Base):
     __tablename__ = 'updates'
     __exclude_columns__ = ('id', 'user_id', 'release_id')
@@ -649,6 +754,65 @@ class Update(Base):
 
     user_id = Column(Integer, ForeignKey('users.id'))
 
+    @classmethod
+    def get_by_titles(cls, titles, db, chunk_size=500):
+        """
+        Return the updates with the given titles, in the same order, using a
+        few chunked IN queries rather than one query per title.
+
+        Their builds, packages, releases, bugs and CVEs are loaded along with
+        them, but their comments are only loaded when they are needed.
+        """
+        titles = list(titles)
+        updates = {}
+        for i in range(0, len(titles), chunk_size):
+            query = db.query(cls).filter(
+                cls.title.in_(titles[i:i + chunk_size])).options(
+                *cls._push_options())
+            for update in query:
+                updates[update.title] = update
+        return [updates[title] for title in titles if title in updates]
+
+    @classmethod
+    def get_by_build_nvrs(cls, nvrs, db, chunk_size=500):
+        """
+        Return the updates of the builds with the given NVRs, keyed by NVR.
+        NVRs of builds that bodhi does not know about, or that are not part
+        of an update, are left out.
+
+        Only the NVR and update ID of the builds are queried, in chunks, and
+        their updates are then loaded in chunks like get_by_titles() does.
+        """
+        nvrs = [unicode(nvr) for nvr in nvrs]
+        update_ids = {}
+        for i in range(0, len(nvrs), chunk_size):
+            query = db.query(Build.nvr, Build.update_id).filter(
+                Build.nvr.in_(nvrs[i:i + chunk_size]),
+                Build.update_id != None)
+            update_ids.update(query)
+
+        ids = list(set(update_ids.values()))
+        updates = {}
+        for i in range(0, len(ids), chunk_size):
+            query = db.query(cls).filter(
+                cls.id.in_(ids[i:i + chunk_size])).options(
+                *cls._push_options())
+            for update in query:
+                updates[update.id] = update
+        return dict((nvr, updates[update_id])
+                    for nvr, update_id in update_ids.items()
+                    if update_id in updates)
+
+    @classmethod
+    def _push_options(cls):
+        """The query options for loading updates to be pushed: their builds,
+        packages, releases, bugs and CVEs, but not their comments"""
+        return (lazyload(cls.comments),
+                joinedload(cls.release),
+                subqueryload(cls.builds).joinedload(Build.package),
+                subqueryload(cls.bugs),
+                subqueryload(cls.cves))
+
     @classmethod
     def new(cls, request, data):
         """ Create a new update """
@@ -1188,19 +1352,20 @@ class Update(Base):
         self.request = None
         self.date_pushed = now
 
-    def modify_bugs(self):
+    def modify_bugs(self, tracker=None):
         """ Comment on and close this updates bugs as necessary
 
-        This typically gets called by the Masher at the end.
+        This typically gets called by the Masher at the end, with a
+        BugWorkQueue as the `tracker`.
         """
         if self.status is UpdateStatus.testing:
             for bug in self.bugs:
                 log.debug('Adding testing comment to bugs for %s', self.title)
-                bug.testing(self)
+                bug.testing(self, tracker=tracker)
         elif self.status is UpdateStatus.stable:
             for bug in self.bugs:
                 log.debug('Adding stable comment to bugs for %s', self.title)
-                bug.add_comment(self)
+                bug.add_comment(self, tracker=tracker)
 
             if self.close_bugs:
                 if self.type is UpdateType.security:
@@ -1209,10 +1374,10 @@ class Update(Base):
                     for bug in self.bugs:
                         if not bug.parent:
                             log.debug("Closing tracker bug %d" % bug.bug_id)
-                            bug.close_bug(self)
+                            bug.close_bug(self, tracker=tracker)
                 else:
                     for bug in self.bugs:
-                        bug.close_bug(self)
+                        bug.close_bug(self, tracker=tracker)
 
     def status_comment(self):
         """
@@ -1557,6 +1722,7 @@ class Update(Base):
         for build in self.builds:
             for tag in build.get_tags():
                 koji.untagBuild(tag, build.nvr, force=True)
+                build.forget_tag(tag)
         self.pushed = False
 
     def obsolete(self, newer=None):
@@ -1587,41 +1753,32 @@ class Update(Base):
                     people.add(committer)
         return list(people)
 
-    def check_requirements(self, session, settings):
+    def check_requirements(self, session, settings, results=None):
         """ Check that an update meets its self-prescribed policy to be pushed
 
         Returns a tuple containing (result, reason) where result is a boolean
         and reason is a string.
+
+        The taskotron results may be given as an index from
+        Update.prefetch_results, otherwise they are fetched for this update.
         """
 
         requirements = tokenize(self.requirements or '')
         requirements = list(requirements)
 
-        try:
-            # https://github.com/fedora-infra/bodhi/issues/362
-            since = self.last_modified.isoformat().rsplit('.', 1)[0]
-        except Exception as e:
-            return False, "Failed to determine last_modified: %r" % e.message
-
-        try:
-            query = dict(title=self.title, since=since)
-            results = bodhi.util.taskotron_results(settings, **query)
-        except IOError as e:
-            return False, "Failed to talk to taskotron: %r" % e.message
+        if results is None:
+            results = Update.prefetch_results([self], settings)
+        if self.title in results.errors:
+            return False, results.errors[self.title]
 
         for testcase in requirements:
-            relevant = [result for result in results
-                        if result['testcase']['name'] == testcase]
+            by_arch = results.get((self.title, testcase))
 
-            if not relevant:
+            if not by_arch:
                 return False, 'No result found for required %s' % testcase
 
-            by_arch = defaultdict(list)
-            for r in relevant:
-                by_arch[r['result_data'].get('arch', ['noarch'])[0]].append(r)
-
-            for arch, results in by_arch.items():
-                latest = results[0]  # TODO - do these need to be sorted still?
+            for arch, results_for_arch in by_arch.items():
+                latest = results_for_arch[0]  # TODO - do these need to be sorted still?
                 if latest['outcome'] not in ['PASSED', 'INFO']:
                     return False, "Required task %s returned %s" % (
                         latest['testcase']['name'], latest['outcome'])
@@ -1630,6 +1787,50 @@ class Update(Base):
 
         return True, "All checks pass."
 
+    @classmethod
+    def prefetch_results(cls, updates, settings):
+        """
+        Fetch the taskotron results of several updates at once, over a pool of
+        at most `taskotron_workers` connections.
+
+        Returns the results indexed by (title, testcase), then by arch, latest
+        first.  Updates without any requirements are skipped.
+        """
+        def fetch(update):
+            if not list(tokenize(update.requirements or '')):
+                return update.title, [], None
+            try:
+                # https://github.com/fedora-infra/bodhi/issues/362
+                since = update.last_modified.isoformat().rsplit('.', 1)[0]
+            except Exception as e:
+                return update.title, [], (
+                    "Failed to determine last_modified: %r" % e.message)
+            try:
+                query = dict(title=update.title, since=since)
+                return update.title, list(bodhi.util.taskotron_results(
+                    settings, session=http, **query)), None
+            except IOError as e:
+                return update.title, [], (
+                    "Failed to talk to taskotron: %r" % e.message)
+
+        workers = int(settings.get('taskotron_workers', 8))
+        http = bodhi.util.http_session(workers)
+        pool = ThreadPool(max(min(len(updates), workers), 1))
+        try:
+            fetched = pool.map(fetch, updates)
+        finally:
+            pool.close()
+            pool.join()
+
+        index = TaskotronResults()
+        for title, results, error in fetched:
+            if error:
+                index.errors[title] = error
+            for result in results:
+                arch = result['result_data'].get('arch', ['noarch'])[0]
+                index[(title, result['testcase']['name'])][arch].append(result)
+        return index
+
     def check_karma_thresholds(self, agent):
         """Check if we have reached either karma threshold, and call set_request if necessary"""
         if not self.locked:
@@ -1944,12 +2145,12 @@ class Bug(Base):
     def url(self):
         return config['buglink'] % self.bug_id
 
-    def update_details(self, bug=None):
+    def update_details(self, bug=None, tracker=None):
         """ Grab details from rhbz to populate our bug fields.
 
         This is typically called "offline" in the UpdatesHandler consumer.
         """
-        bugtracker.update_details(bug, self)
+        (tracker or bugtracker).update_details(bug, self)
 
     def default_message(self, update):
         message = config['stable_bug_msg'] % (
@@ -1969,7 +2170,7 @@ class Bug(Base):
                 config.get('base_address') + update.get_url())
         return message
 
-    def add_comment(self, update, comment=None):
+    def add_comment(self, update, comment=None, tracker=None):
         if (update.type is UpdateType.security and self.parent and
                 update.status is not UpdateStatus.stable):
             log.debug('Not commenting on parent security bug %s', self.bug_id)
@@ -1977,9 +2178,9 @@ class Bug(Base):
             if not comment:
                 comment = self.default_message(update)
             log.debug("Adding comment to Bug #%d: %s" % (self.bug_id, comment))
-            bugtracker.comment(self.bug_id, comment)
+            (tracker or bugtracker).comment(self.bug_id, comment)
 
-    def testing(self, update):
+    def testing(self, update, tracker=None):
         """
         Change the status of this bug to ON_QA, and comment on the bug with
         some details on how to test and provide feedback for this update.
@@ -1989,15 +2190,15 @@ class Bug(Base):
             log.debug('Not modifying on parent security bug %s', self.bug_id)
         else:
             comment = self.default_message(update)
-            bugtracker.on_qa(self.bug_id, comment)
+            (tracker or bugtracker).on_qa(self.bug_id, comment)
 
-    def close_bug(self, update):
+    def close_bug(self, update, tracker=None):
         # Build a mapping of package names to build versions
         # so that .close() can figure out which build version fixes which bug.
         versions = dict([
             (get_nvr(b.nvr)[0], b.nvr) for b in update.builds
         ])
-        bugtracker.close(self.bug_id, versions=versions)
+        (tracker or bugtracker).close(self.bug_id, versions=versions)
 
     def modified(self, update):
         """ Change the status of this bug to MODIFIED """
@@ -2185,3 +2386,67 @@ class Stack(Base):
     # Many-to-many relationships
     groups = relationship("Group", secondary=stack_group_table, backref='stacks')
     users = relationship("User", secondary=stack_user_table, backref='stacks')
+
+
+class RepoLease(Base):
+    """
+    A lease on a repository, held by the masher that is pushing it.
+
+    Leases are taken, renewed and released in their own short transactions, on
+    a session that is not managed by the transaction of the push, so that the
+    mashers on other hosts see them straight away.  A lease that has not been
+    renewed within its timeout was left behind by a masher that died, and is
+    reclaimed by the next masher to ask for it.
+    """
+    __tablename__ = 'repo_leases'
+    __get_by__ = ('tag',)
+
+    tag = Column(Unicode(64), unique=True, nullable=False)
+    owner = Column(Unicode(255), nullable=False)
+    acquired = Column(DateTime, default=datetime.utcnow, nullable=False)
+    heartbeat = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+    @classmethod
+    def acquire(cls, session, tag, owner, timeout):
+        """Take the lease on a repo, returning whether we got it"""
+        now = datetime.utcnow()
+        try:
+            session.add(cls(tag=tag, owner=owner, acquired=now, heartbeat=now))
+            session.commit()
+            return True
+        except IntegrityError:
+            session.rollback()
+
+        # Someone else holds it, so take it over if it has expired.  Only
+        # one masher can win this, since the row is checked as it is updated.
+        expired = now - timedelta(seconds=timeout)
+        reclaimed = session.query(cls).filter(and_(
+            cls.tag == tag,
+            or_(cls.heartbeat < expired, cls.owner == owner),
+        )).update({'owner': owner, 'acquired': now, 'heartbeat': now},
+                  synchronize_session=False)
+        session.commit()
+        if reclaimed:
+            log.warn('Reclaimed the expired lease on %s' % tag)
+        return bool(reclaimed)
+
+    @classmethod
+    def renew(cls, session, tag, owner):
+        """Renew the heartbeat of our lease, returning whether we still hold it"""
+        renewed = session.query(cls).filter_by(tag=tag, owner=owner).update(
+            {'heartbeat': datetime.utcnow()}, synchronize_session=False)
+        session.commit()
+        return bool(renewed)
+
+    @classmethod
+    def release(cls, session, tag, owner):
+        """Give up our lease on a repo"""
+        session.query(cls).filter_by(tag=tag, owner=owner).delete(
+            synchronize_session=False)
+        session.commit()
+
+    @classmethod
+    def holder(cls, session, tag):
+        """Return the owner of the lease on a repo, if any"""
+        lease = session.query(cls).filter_by(tag=tag).first()
+        return lease.owner if lease else None
@@ -16,7 +16,6 @@ The tool for triggering updates pushes.
 """
 
 import click
-import json
 import glob
 
 from collections import defaultdict
@@ -24,6 +23,8 @@ from fedora.client.bodhi import Bodhi2Client
 
 import bodhi.notifications
 
+from bodhi.util import StateJournal
+
 
 @click.command()
 @click.option('--releases', help='Push updates for specific releases')
@@ -54,8 +55,7 @@ def push(username, password, cert_prefix, **kwargs):
             if doit == 'n':
                 continue
 
-            with file(lockfile) as lock:
-                state = json.load(lock)
+            state = StateJournal(lockfile).replay()
 
             click.echo(lockfile)
             for update in state['updates']:
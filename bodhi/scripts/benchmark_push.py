@@ -0,0 +1,284 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+A simulated end-to-end push, for measuring the masher without koji, bugzilla
+or resultsdb.
+
+A throwaway database is seeded with a number of updates spread over several
+releases, and pushed by a Masher that talks to the DevBuildsys and the
+FakeBugTracker.  Every call to them, and to resultsdb, is delayed by a
+configurable latency, so that the effect of batching and concurrency on the
+round trips shows up in the timings.
+
+The mash itself, the updateinfo, the sanity check and the mirror sync are
+stubbed out, since they depend on real repositories.  The wall time and calls
+of every other stage are summed over all of the repos pushed.
+"""
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+from collections import OrderedDict
+from datetime import datetime
+
+import click
+
+from sqlalchemy import create_engine
+
+import bodhi.bugs
+import bodhi.util
+import bodhi.models.models
+
+from bodhi import buildsys, stats
+from bodhi.bugs import FakeBugTracker
+from bodhi.config import config
+from bodhi.consumers.masher import Masher, MasherThread, PushQueue
+from bodhi.models import (DBSession, Base, Bug, Build, Package, Release,
+                          Update, UpdateRequest, UpdateStatus, UpdateType,
+                          User)
+from bodhi.util import transactional_session_maker
+
+log = logging.getLogger('bodhi')
+
+
+class Latency(object):
+    """
+    Wrap a koji session or a bug tracker, so that every call to its public
+    methods takes `latency` seconds longer.
+
+    Like a real koji hub, calls queued in multicall mode only pay the latency
+    once, when the multiCall() round trip is made.
+    """
+
+    def __init__(self, obj, latency):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_latency', latency)
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def delayed(*args, **kw):
+            if attr == 'multiCall' or not getattr(self._obj, 'multicall',
+                                                  False):
+                time.sleep(self._latency)
+            return value(*args, **kw)
+        return delayed
+
+    def __setattr__(self, attr, value):
+        setattr(self._obj, attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._obj, attr)
+
+
+def fake_taskotron_results(latency):
+    """Return a stand-in for bodhi.util.taskotron_results, which passes every
+    update after `latency` seconds"""
+    def taskotron_results(settings, entity='results', session=None, **kwargs):
+        time.sleep(latency)
+        return [{
+            'outcome': 'PASSED',
+            'result_data': {},
+            'testcase': {'name': 'rpmlint'},
+        }]
+    return taskotron_results
+
+
+class BenchmarkMasherThread(MasherThread):
+    """A MasherThread with the stages that need real repositories stubbed"""
+
+    def mash(self):
+        self.log.debug('Skipping the mash of %s', self.id)
+
+    def generate_updateinfo(self):
+        pass
+
+    def update_repodata(self, uinfo):
+        pass
+
+    def update_comps(self):
+        pass
+
+    def sanity_check_repo(self):
+        pass
+
+    def stage_repo(self):
+        pass
+
+    def wait_for_sync(self):
+        pass
+
+
+class BenchmarkMasher(Masher):
+    """A Masher that is driven directly, rather than by fedmsg"""
+
+    def __init__(self, db_factory, mash_dir):
+        self.db_factory = db_factory
+        self.mash_dir = mash_dir
+        self.queue = PushQueue()
+        self.thread_class = BenchmarkMasherThread
+        self.log = log
+        self.start_pusher()
+
+
+def populate(db, updates, releases):
+    """Seed the database with `updates` updates over `releases` releases, and
+    return their titles.  Every other update is pushed to stable."""
+    user = User(name=u'guest')
+    db.add(user)
+    rels = []
+    for i in range(releases):
+        version = 17 + i
+        tag = u'f%d' % version
+        release = Release(
+            name=u'F%d' % version, long_name=u'Fedora %d' % version,
+            id_prefix=u'FEDORA', version=unicode(version),
+            dist_tag=tag, stable_tag=u'%s-updates' % tag,
+            testing_tag=u'%s-updates-testing' % tag,
+            candidate_tag=u'%s-updates-candidate' % tag,
+            pending_testing_tag=u'%s-updates-testing-pending' % tag,
+            pending_stable_tag=u'%s-updates-pending' % tag,
+            override_tag=u'%s-override' % tag,
+            branch=tag)
+        db.add(release)
+        rels.append(release)
+    db.flush()
+
+    titles = []
+    for i in range(updates):
+        release = rels[i % releases]
+        pkg = Package(name=u'pkg%d' % i)
+        db.add(pkg)
+        nvr = u'%s-1.0-1.fc%s' % (pkg.name, release.version)
+        build = Build(nvr=nvr, release=release, package=pkg)
+        db.add(build)
+        stable = i % 2
+        update = Update(
+            title=nvr, builds=[build], user=user, release=release,
+            request=stable and UpdateRequest.stable or UpdateRequest.testing,
+            status=stable and UpdateStatus.testing or UpdateStatus.pending,
+            notes=u'Benchmark update', requirements=u'rpmlint',
+            date_submitted=datetime.utcnow(),
+            stable_karma=3, unstable_karma=-3,
+            alias=u'FEDORA-%d-%04d' % (datetime.utcnow().year, i + 1))
+        update.type = UpdateType.bugfix
+        bug = Bug(bug_id=100000 + i)
+        db.add(bug)
+        update.bugs.append(bug)
+        db.add(update)
+        titles.append(nvr)
+    db.flush()
+    return titles
+
+
+def collect_stats(mash_dir):
+    """Sum the stage stats of every repo pushed, and keep the largest resident
+    set sizes seen"""
+    totals = OrderedDict()
+    for name in sorted(os.listdir(mash_dir)):
+        if not name.endswith('.stats.json'):
+            continue
+        with file(os.path.join(mash_dir, name)) as f:
+            stages = json.load(f, object_pairs_hook=OrderedDict)
+        for stage, report in stages.items():
+            total = totals.setdefault(stage, OrderedDict())
+            for key, value in report.items():
+                if key in ('rss_start_kb', 'rss_end_kb', 'peak_rss_kb'):
+                    total[key] = max(total.get(key, 0), value)
+                else:
+                    total[key] = total.get(key, 0) + value
+    return totals
+
+
+@click.command()
+@click.option('--updates', default=100, help='The number of updates to push')
+@click.option('--releases', default=2,
+              help='The number of releases to spread them over')
+@click.option('--koji-latency', default=0.05, help='Seconds per koji call')
+@click.option('--bugzilla-latency', default=0.2,
+              help='Seconds per bugzilla call')
+@click.option('--resultsdb-latency', default=0.1,
+              help='Seconds per resultsdb query')
+@click.option('--output', type=click.Path(),
+              help='Also write the stage stats to this JSON file')
+@click.option('--verbose', is_flag=True, default=False)
+def main(updates, releases, koji_latency, bugzilla_latency,
+         resultsdb_latency, output, verbose):
+    logging.basicConfig()
+    log.setLevel(verbose and logging.DEBUG or logging.ERROR)
+
+    tempdir = tempfile.mkdtemp(prefix='bodhi-benchmark-')
+    mash_dir = os.path.join(tempdir, 'mash')
+    os.makedirs(mash_dir)
+    try:
+        engine = create_engine('sqlite:///%s' %
+                               os.path.join(tempdir, 'bodhi.db'))
+        DBSession.configure(bind=engine)
+        Base.metadata.create_all(engine)
+        db_factory = transactional_session_maker
+        with db_factory() as session:
+            titles = populate(session, updates, releases)
+
+        config['fedmsg_enabled'] = False
+        config['smtp_server'] = ''
+        config['compose_atomic_trees'] = ''
+        buildsys._buildsystem = lambda: Latency(buildsys.DevBuildsys(),
+                                                koji_latency)
+        buildsys.DevBuildsys().clear()
+        bugtracker = stats.CallCounter(
+            Latency(FakeBugTracker(), bugzilla_latency), 'bugzilla')
+        bodhi.bugs.bugtracker = bugtracker
+        bodhi.models.models.bugtracker = bugtracker
+        bodhi.util.taskotron_results = fake_taskotron_results(
+            resultsdb_latency)
+
+        masher = BenchmarkMasher(db_factory, mash_dir)
+        start = time.time()
+        masher.work({'body': {'msg': {'updates': titles}}})
+        masher.queue.join()
+        wall_time = time.time() - start
+        masher.stop()
+
+        totals = collect_stats(mash_dir)
+    finally:
+        DBSession.remove()
+        shutil.rmtree(tempdir)
+
+    click.echo('%-32s %10s %8s %8s %8s %10s %10s %10s' % (
+        'stage', 'wall (s)', 'koji', 'bugzilla', 'db', 'rss (kB)',
+        '+rss (kB)', 'peak (kB)'))
+    for stage, report in totals.items():
+        click.echo('%-32s %10.2f %8d %8d %8d %10d %10d %10d' % (
+            stage, report['wall_time'], report['koji_calls'],
+            report['bugzilla_calls'], report['db_queries'],
+            report['rss_end_kb'],
+            report['rss_end_kb'] - report['rss_start_kb'],
+            report['peak_rss_kb']))
+    click.echo('Pushed %d updates over %d releases in %.2fs' % (
+        updates, releases, wall_time))
+
+    if output:
+        with file(output, 'w') as f:
+            json.dump(dict(updates=updates, releases=releases,
+                           wall_time=wall_time, stages=totals), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
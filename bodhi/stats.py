@@ -0,0 +1,156 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Counters of the koji, bugzilla and database calls made by a piece of work.
+
+Counts are collected per thread: a call is added to the innermost collect()
+block of the thread that made it.  Thread pools can hand their parent's
+counters to their workers with adopt().
+"""
+
+import time
+import resource
+import threading
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class Counts(defaultdict):
+    """The number of calls of each kind, which is safe to update from
+    several threads at once"""
+
+    def __init__(self):
+        super(Counts, self).__init__(int)
+        self.lock = threading.Lock()
+
+    def add(self, name, count=1):
+        with self.lock:
+            self[name] += count
+
+
+def current():
+    """Return the counts being collected by this thread, if any"""
+    return getattr(_local, 'counts', None)
+
+
+def adopt(counts):
+    """Add the calls of this thread to `counts`, for use as the initializer
+    of a thread pool"""
+    _local.counts = counts
+
+
+def count(name, n=1):
+    counts = current()
+    if counts is not None:
+        counts.add(name, n)
+
+
+@contextmanager
+def collect():
+    """
+    Collect the calls made by this thread within the block.  They are also
+    added to any enclosing block once this one finishes.
+    """
+    previous = current()
+    counts = _local.counts = Counts()
+    try:
+        yield counts
+    finally:
+        _local.counts = previous
+        if previous is not None:
+            for name, n in counts.items():
+                previous.add(name, n)
+
+
+def rss_kb():
+    """Return the current resident set size of the process in kB, or 0 where
+    /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return 0
+    return pages * resource.getpagesize() // 1024
+
+
+@contextmanager
+def measure(report):
+    """
+    Add the wall time and calls of the block to the `report` dict, even if the
+    block fails.
+
+    The resident set size of the process is sampled when the block is first
+    entered and whenever it is left, as `rss_start_kb` and `rss_end_kb`.  The
+    peak resident set size of the process so far is also recorded as it is
+    left, as `peak_rss_kb`, which is the high-water mark of the whole process
+    rather than of the block alone.
+    """
+    report.setdefault('rss_start_kb', rss_kb())
+    start = time.time()
+    try:
+        with collect() as counts:
+            yield
+    finally:
+        for key, value in (('wall_time', time.time() - start),
+                           ('koji_calls', counts['koji']),
+                           ('bugzilla_calls', counts['bugzilla']),
+                           ('db_queries', counts['db'])):
+            report[key] = report.get(key, 0) + value
+        report['rss_end_kb'] = rss_kb()
+        report['peak_rss_kb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+
+
+class CallCounter(object):
+    """
+    Wrap an object, such as a koji session, so that calls to its public
+    methods are counted under `name`.
+
+    Calls queued while a koji session is in multicall mode are only counted
+    once, when the multiCall() round trip is made.
+    """
+
+    def __init__(self, obj, name):
+        object.__setattr__(self, '_obj', obj)
+        object.__setattr__(self, '_name', name)
+
+    def __getattr__(self, attr):
+        value = getattr(self._obj, attr)
+        if attr.startswith('_') or not callable(value):
+            return value
+
+        def counted(*args, **kw):
+            if attr == 'multiCall' or not getattr(self._obj, 'multicall',
+                                                  False):
+                count(self._name)
+            return value(*args, **kw)
+        return counted
+
+    def __setattr__(self, attr, value):
+        setattr(self._obj, attr, value)
+
+    def __delattr__(self, attr):
+        delattr(self._obj, attr)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    count('db')
@@ -139,6 +139,31 @@ class TestBuild(ModelTest):
         eq_(len(self.obj.release.builds), 1)
         eq_(self.obj.release.builds[0], self.obj)
 
+    def test_prefetch_tags(self):
+        buildsys.setup_buildsystem({'buildsystem': 'dev'})
+        koji = buildsys.get_session()
+        model.Build.prefetch_tags([self.obj], koji)
+        tags = self.obj.get_tags()
+        eq_(tags, [u'f11-updates-candidate', u'f11', u'f11-updates-testing'])
+
+        # The prefetched tags are used instead of asking koji again
+        with mock.patch.object(buildsys.DevBuildsys, 'listTags') as listTags:
+            eq_(self.obj.get_tags(koji), tags)
+        eq_(listTags.call_count, 0)
+
+        self.obj.forget_tag(u'f11')
+        eq_(self.obj.get_tags(), [u'f11-updates-candidate',
+                                  u'f11-updates-testing'])
+
+        # When they can not be refreshed, the tags are looked up again
+        with mock.patch.object(buildsys, 'chunked_multicall',
+                               return_value=[None]):
+            model.Build.prefetch_tags([self.obj], koji)
+        with mock.patch.object(buildsys.DevBuildsys, 'listTags',
+                               return_value=[{'name': u'f11'}]) as listTags:
+            eq_(self.obj.get_tags(koji), [u'f11'])
+        eq_(listTags.call_count, 1)
+
     def test_package_relation(self):
         eq_(self.obj.package.name, u"TurboGears")
         eq_(len(self.obj.package.builds), 1)
@@ -204,6 +229,73 @@ class TestUpdate(ModelTest):
             ))
         return self.klass(**attrs)
 
+    def test_get_by_titles(self):
+        update = self.get_update(name=u'TurboGears-1.0.8-4.fc11')
+        update.title = u'TurboGears-1.0.8-4.fc11'
+        model.DBSession.add(update)
+        model.DBSession.flush()
+        titles = [u'TurboGears-1.0.8-4.fc11', u'nethack-3.4.5-1.fc10',
+                  self.obj.title]
+        updates = model.Update.get_by_titles(titles, model.DBSession,
+                                             chunk_size=1)
+        eq_(updates, [update, self.obj])
+        eq_(len(updates[1].bugs), 2)
+
+    def test_get_by_build_nvrs(self):
+        update = self.get_update(name=u'TurboGears-1.0.8-4.fc11')
+        update.title = u'TurboGears-1.0.8-4.fc11'
+        model.DBSession.add(update)
+        # A build without an update is left out too
+        model.DBSession.add(model.Build(
+            nvr=u'TurboGears-1.0.8-5.fc11', package=update.builds[0].package))
+        model.DBSession.flush()
+        nvrs = ['TurboGears-1.0.8-3.fc11', 'TurboGears-1.0.8-4.fc11',
+                'TurboGears-1.0.8-5.fc11', 'nethack-3.4.5-1.fc10']
+        updates = model.Update.get_by_build_nvrs(nvrs, model.DBSession,
+                                                 chunk_size=1)
+        eq_(updates, {u'TurboGears-1.0.8-3.fc11': self.obj,
+                      u'TurboGears-1.0.8-4.fc11': update})
+        eq_(len(updates[u'TurboGears-1.0.8-3.fc11'].bugs), 2)
+
+    @mock.patch('bodhi.util.taskotron_results')
+    def test_check_requirements(self, taskotron_results):
+        def result(testcase, outcome, arch):
+            return {'testcase': {'name': testcase}, 'outcome': outcome,
+                    'result_data': {'arch': [arch]}}
+        # The results are a generator, which every requirement must see
+        taskotron_results.side_effect = lambda *args, **kw: iter([
+            result(u'depcheck', u'FAILED', u'x86_64'),
+            result(u'rpmlint', u'PASSED', u'x86_64'),
+            result(u'depcheck', u'PASSED', u'x86_64'),
+            result(u'depcheck', u'PASSED', u'i386'),
+        ])
+        self.obj.requirements = u'rpmlint depcheck'
+        results = model.Update.prefetch_results([self.obj], config)
+        eq_(len(results[(self.obj.title, u'depcheck')][u'x86_64']), 2)
+        eq_(self.obj.check_requirements(model.DBSession, config, results),
+            (False, 'Required task depcheck returned FAILED'))
+
+        self.obj.requirements = u'rpmlint'
+        eq_(self.obj.check_requirements(model.DBSession, config),
+            (True, 'All checks pass.'))
+        self.obj.requirements = u'rpmlint upgradepath'
+        eq_(self.obj.check_requirements(model.DBSession, config),
+            (False, 'No result found for required upgradepath'))
+
+    @mock.patch('bodhi.util.taskotron_results')
+    def test_check_requirements_taskotron_down(self, taskotron_results):
+        taskotron_results.side_effect = IOError('taskotron is down')
+        self.obj.requirements = u'rpmlint'
+        eq_(self.obj.check_requirements(model.DBSession, config),
+            (False, "Failed to talk to taskotron: 'taskotron is down'"))
+
+        # Updates without requirements do not ask taskotron at all
+        taskotron_results.reset_mock()
+        self.obj.requirements = u''
+        eq_(self.obj.check_requirements(model.DBSession, config),
+            (True, 'All checks pass.'))
+        eq_(taskotron_results.call_count, 0)
+
     def test_builds(self):
         eq_(len(self.obj.builds), 1)
         eq_(self.obj.builds[0].nvr, u'TurboGears-1.0.8-3.fc11')
@@ -0,0 +1,96 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import mock
+import unittest
+
+from bodhi.bugs import Bugzilla, BugWorkQueue, FakeBugTracker, RateLimiter
+from bodhi.config import config
+
+
+class TestBugWorkQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = FakeBugTracker()
+        self.calls = []
+
+        def record(name):
+            def call(*args, **kw):
+                self.calls.append((name,) + args)
+            return call
+
+        for name in ('getbugs', 'comment', 'on_qa', 'close', 'modified'):
+            setattr(self.tracker, name, mock.Mock(side_effect=record(name)))
+
+    @mock.patch.dict(config, {'bz_prefetch_chunk_size': '2'})
+    def test_join(self):
+        queue = BugWorkQueue(self.tracker)
+        queue.comment(1, u'pushed')
+        queue.on_qa(2, u'testing')
+        queue.close(1, versions={'bodhi': 'bodhi-2.0-1.fc17'})
+        queue.modified(3)
+
+        # Nothing is sent to bugzilla until the queue is joined
+        self.assertEquals(self.calls, [])
+        self.assertEquals(queue.join(), 0)
+
+        # Each chunk of bugs is prefetched at once
+        self.assertIn(('getbugs', [1, 2]), self.calls)
+        self.assertIn(('getbugs', [3]), self.calls)
+        self.assertEquals(len(self.calls), 6)
+
+        # The calls for each bug are made in order
+        calls = [call for call in self.calls if call[1] == 1]
+        self.assertEquals(calls, [('comment', 1, u'pushed'), ('close', 1)])
+
+    @mock.patch.dict(config, {'bz_retries': '2'})
+    def test_retries(self):
+        self.tracker.comment.side_effect = [Exception('bugzilla is down'),
+                                            None]
+        self.tracker.modified.side_effect = Exception('bugzilla is down')
+        queue = BugWorkQueue(self.tracker)
+        queue.comment(1, u'pushed')
+        queue.modified(2)
+
+        self.assertEquals(queue.join(), 1)
+        self.assertEquals(self.tracker.comment.call_count, 2)
+        self.assertEquals(self.tracker.modified.call_count, 3)
+
+    @mock.patch.dict(config, {'bz_rate_limit': '0'})
+    def test_bugzilla_retries(self):
+        bz = mock.Mock()
+        bz.getbugs.return_value = []
+        bug = bz.getbug.return_value
+        bug.addcomment.side_effect = [Exception('bugzilla is down')] * 2 + [
+            None]
+        with mock.patch.object(Bugzilla, 'bz', bz):
+            tracker = Bugzilla()
+            # The failure is only logged when bugzilla is called directly
+            tracker.comment(1, u'pushed')
+
+            # while the queue retries it, and it goes through the second time
+            queue = BugWorkQueue(tracker)
+            queue.comment(1, u'pushed')
+            self.assertEquals(queue.join(), 0)
+        self.assertEquals(bug.addcomment.call_args_list,
+                          [mock.call(u'pushed')] * 3)
+
+    @mock.patch('bodhi.bugs.time.sleep')
+    @mock.patch('bodhi.bugs.time.time', return_value=100.0)
+    def test_rate_limiter(self, time, sleep):
+        limiter = RateLimiter(4)
+        for i in range(3):
+            limiter.wait()
+        self.assertEquals(sleep.call_args_list,
+                          [mock.call(0.25), mock.call(0.5)])
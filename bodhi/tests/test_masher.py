@@ -16,19 +16,28 @@ import os
 import mock
 import time
 import json
+import urllib2
+import hashlib
 import shutil
 import unittest
 import tempfile
+import threading
+
+from datetime import datetime, timedelta
+from operator import attrgetter
 
 from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
 
-from bodhi import buildsys, log
+from bodhi import buildsys, log, mail, util
 from bodhi.config import config
-from bodhi.consumers.masher import Masher, MasherThread
+from bodhi.exceptions import RepodataException
+from bodhi.consumers.masher import (Masher, MasherThread, MashThread,
+                                    PushQueue)
 from bodhi.models import (DBSession, Base, Update, User, Release,
-                          Build, UpdateRequest, UpdateType,
+                          Build, Bug, UpdateRequest, UpdateType,
                           ReleaseState, BuildrootOverride,
-                          UpdateStatus)
+                          UpdateStatus, RepoLease)
 from bodhi.tests import populate
 
 from bodhi.util import mkmetadatadir, transactional_session_maker
@@ -74,6 +83,9 @@ class FakeHub(object):
     def subscribe(self, *args, **kw):
         pass
 
+    def close(self):
+        self.closed = True
+
 
 def makemsg(body=None):
     if not body:
@@ -127,6 +139,7 @@ class TestMasher(unittest.TestCase):
         self.masher = Masher(FakeHub(), db_factory=self.db_factory, mash_dir=self.tempdir)
 
     def tearDown(self):
+        self.masher.stop()
         shutil.rmtree(self.tempdir)
         try:
             DBSession.remove()
@@ -136,6 +149,11 @@ class TestMasher(unittest.TestCase):
             except:
                 pass
 
+    def consume(self, msg):
+        """Hand a message to the masher and wait for its repos to be pushed"""
+        self.masher.consume(msg)
+        self.masher.queue.join()
+
     def set_stable_request(self, title):
         with self.db_factory() as session:
             query = session.query(Update).filter_by(title=title)
@@ -150,8 +168,10 @@ class TestMasher(unittest.TestCase):
         """
         fakehub = FakeHub()
         fakehub.config['releng_fedmsg_certname'] = 'foo'
-        self.masher = Masher(fakehub, db_factory=self.db_factory)
-        self.masher.consume(self.msg)
+        self.masher.stop()
+        self.masher = Masher(fakehub, db_factory=self.db_factory,
+                             mash_dir=self.tempdir)
+        self.consume(self.msg)
 
         # Make sure the update did not get locked
         with self.db_factory() as session:
@@ -166,7 +186,7 @@ class TestMasher(unittest.TestCase):
     def test_push_invalid_update(self, publish):
         msg = makemsg()
         msg['body']['msg']['updates'] = 'invalidbuild-1.0-1.fc17'
-        self.masher.consume(msg)
+        self.consume(msg)
         self.assertEquals(len(publish.call_args_list), 1)
 
     @mock.patch(**mock_taskotron_results)
@@ -184,10 +204,10 @@ class TestMasher(unittest.TestCase):
             up = session.query(Update).one()
             self.assertFalse(up.locked)
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         # Ensure that fedmsg was called 4 times
-        self.assertEquals(len(publish.call_args_list), 3)
+        self.assertEquals(len(publish.call_args_list), 4)
 
         # Also, ensure we reported success
         publish.assert_called_with(
@@ -208,6 +228,44 @@ class TestMasher(unittest.TestCase):
             except LockedUpdateException:
                 pass
 
+    @mock.patch(**mock_taskotron_results)
+    @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
+    @mock.patch('bodhi.consumers.masher.MashThread.run')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_mash')
+    @mock.patch('bodhi.consumers.masher.MasherThread.sanity_check_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.generate_updateinfo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_sync')
+    @mock.patch('bodhi.notifications.publish')
+    def test_stage_stats(self, publish, *args):
+        self.consume(self.msg)
+
+        reports = [name for name in os.listdir(self.tempdir)
+                   if name.endswith('.stats.json')]
+        self.assertEquals(len(reports), 1)
+        self.assertTrue(reports[0].startswith('f17-updates-testing-'))
+        with file(os.path.join(self.tempdir, reports[0])) as f:
+            stages = json.load(f)
+
+        self.assertEquals(sorted(stages['load_updates'].keys()),
+                          ['bugzilla_calls', 'db_queries', 'koji_calls',
+                           'peak_rss_kb', 'rss_end_kb', 'rss_start_kb',
+                           'wall_time'])
+        self.assertTrue(stages['load_updates']['rss_end_kb'] > 0)
+        self.assertTrue(stages['load_updates']['peak_rss_kb'] > 0)
+        # The updates are loaded along with their builds, bugs and CVEs
+        self.assertEquals(stages['load_updates']['db_queries'], 4)
+        # The tags of every build are looked up in one multicall, twice
+        self.assertEquals(stages['prefetch_tags']['koji_calls'], 2)
+        self.assertTrue(stages['determine_and_perform_tag_actions']
+                        ['koji_calls'] > 0)
+        # One getbugs prefetch, and one on_qa
+        self.assertEquals(stages['modify_bugs']['bugzilla_calls'], 2)
+
+        publish.assert_any_call(topic='mashtask.stats', force=True,
+                                msg=dict(repo='f17-updates-testing',
+                                         stages=mock.ANY))
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
     @mock.patch('bodhi.consumers.masher.MashThread.run')
@@ -230,10 +288,10 @@ class TestMasher(unittest.TestCase):
                                            pending_testing_tag]
 
         # Start the push
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
-        # Ensure that fedmsg was called 3 times
-        self.assertEquals(len(publish.call_args_list), 4)
+        # Ensure that fedmsg was called 5 times
+        self.assertEquals(len(publish.call_args_list), 5)
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
@@ -258,7 +316,7 @@ class TestMasher(unittest.TestCase):
 
         self.koji.clear()
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         # Ensure that stable updates to pending releases get their
         # tags added, not removed
@@ -285,11 +343,46 @@ class TestMasher(unittest.TestCase):
         with file(t.mash_lock) as f:
             state = json.load(f)
         try:
-            self.assertEquals(state, {u'tagged': False, u'updates':
-                [u'bodhi-2.0-1.fc17'], u'completed_repos': []})
+            self.assertEquals(state, {u'updates': [u'bodhi-2.0-1.fc17'],
+                                      u'completed_repos': []})
         finally:
             t.remove_state()
 
+    def test_state_journal(self):
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17',
+                                              u'foo-1.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.id = 'f17-updates-testing'
+        t.init_state()
+        t.save_state()
+
+        # Each change is a single line appended to the journal
+        t.record_state('remove', 'updates', u'foo-1.0-1.fc17')
+        path = os.path.join(self.tempdir, u'f17-updates-testing-151018.1200')
+        t.record_state('append', 'completed_repos', path)
+        t.record_state('set', 'update_comps', True)
+        with file(t.mash_lock) as f:
+            self.assertEquals(len(f.readlines()), 4)
+
+        # A crash in the middle of an append only loses that change
+        with file(t.mash_lock, 'a') as f:
+            f.write('["set", "stage_r')
+
+        t = MasherThread(u'F17', u'testing', [], log, self.db_factory,
+                         self.tempdir, resume=True)
+        t.id = 'f17-updates-testing'
+        t.init_state()
+        t.load_state()
+        self.assertEquals(t.state, {u'updates': [u'bodhi-2.0-1.fc17'],
+                                    u'completed_repos': [path],
+                                    u'update_comps': True})
+        self.assertEquals(t.path, path)
+
+        # Loading compacts the journal into a snapshot
+        with file(t.mash_lock) as f:
+            self.assertEquals(json.load(f), t.state)
+        t.remove_state()
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
     @mock.patch('bodhi.consumers.masher.MashThread.run')
@@ -307,7 +400,7 @@ class TestMasher(unittest.TestCase):
             t.db = session
             t.work()
             t.db = None
-        self.assertEquals(t.testing_digest[u'Fedora 17'][u'bodhi-2.0-1.fc17'], """\
+        self.assertEquals(t.read_digest(u'Fedora 17', u'bodhi-2.0-1.fc17'), """\
 ================================================================================
  libseccomp-2.1.0-1.fc20 (FEDORA-%s-0001)
  Enhanced seccomp library
@@ -335,6 +428,7 @@ References:
         t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
                          log, self.db_factory, self.tempdir)
         t.id = 'f17-updates-testing'
+        t.init_state()
         t.init_path()
 
         # test without any arches
@@ -365,10 +459,30 @@ References:
         except RepodataException:
             pass
 
+    @mock.patch('bodhi.consumers.masher.sanity_check_repodata')
+    def test_sanity_check_failure(self, sanity_check_repodata):
+        def check(repodata):
+            if 'i386' in repodata:
+                raise RepodataException('busted')
+        sanity_check_repodata.side_effect = check
+
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.id = 'f17-updates-testing'
+        t.init_state()
+        t.init_path()
+        for arch in ('i386', 'x86_64', 'armhfp'):
+            os.makedirs(os.path.join(t.path, t.id, arch, 'repodata'))
+
+        # The arches are checked in worker processes, and a failure on any
+        # one of them fails the whole check
+        self.assertRaises(RepodataException, t.sanity_check_repo)
+
     def test_stage(self):
         t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
                          log, self.db_factory, self.tempdir)
         t.id = 'f17-updates-testing'
+        t.init_state()
         t.init_path()
         t.stage_repo()
         stage_dir = config.get('mash_stage_dir')
@@ -383,6 +497,7 @@ References:
     @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
     @mock.patch('bodhi.consumers.masher.MasherThread.generate_updateinfo')
     @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_sync')
+    @mock.patch.dict(config, {'max_concurrent_mashes': '1'})
     @mock.patch('bodhi.notifications.publish')
     def test_security_update_priority(self, publish, *args):
         with self.db_factory() as db:
@@ -418,7 +533,7 @@ References:
 
         self.msg['body']['msg']['updates'] += ['bodhi-2.0-1.fc18']
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         # Ensure that F18 runs before F17
         calls = publish.mock_calls
@@ -427,19 +542,22 @@ References:
         # mashing f18
         # complete.stable (for each update)
         # errata.publish
+        # mashtask.stats
         # mashtask.complete
         # mashing f17
         # complete.testing
+        # mashtask.stats
         # mashtask.complete
         self.assertEquals(calls[1], mock.call(
             force=True,
             msg={'repo': u'f18-updates', 'updates': [u'bodhi-2.0-1.fc18']},
             topic='mashtask.mashing'))
-        self.assertEquals(calls[4], mock.call(
+        self.assertEquals(calls[4][2]['topic'], 'mashtask.stats')
+        self.assertEquals(calls[5], mock.call(
             force=True,
             msg={'success': True, 'repo': 'f18-updates'},
             topic='mashtask.complete'))
-        self.assertEquals(calls[5], mock.call(
+        self.assertEquals(calls[6], mock.call(
             force=True,
             msg={'repo': u'f17-updates-testing',
                  'updates': [u'bodhi-2.0-1.fc17']},
@@ -457,6 +575,7 @@ References:
     @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
     @mock.patch('bodhi.consumers.masher.MasherThread.generate_updateinfo')
     @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_sync')
+    @mock.patch.dict(config, {'max_concurrent_mashes': '1'})
     @mock.patch('bodhi.notifications.publish')
     def test_security_update_priority_testing(self, publish, *args):
         with self.db_factory() as db:
@@ -494,7 +613,7 @@ References:
 
         self.msg['body']['msg']['updates'] += ['bodhi-2.0-1.fc18']
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         # Ensure that F17 updates-testing runs before F18
         calls = publish.mock_calls
@@ -503,11 +622,12 @@ References:
                  'updates': [u'bodhi-2.0-1.fc17']},
             force=True,
             topic='mashtask.mashing'))
-        self.assertEquals(calls[3], mock.call(
+        self.assertEquals(calls[3][2]['topic'], 'mashtask.stats')
+        self.assertEquals(calls[4], mock.call(
             msg={'success': True, 'repo': 'f17-updates-testing'},
             force=True,
             topic='mashtask.complete'))
-        self.assertEquals(calls[4], mock.call(
+        self.assertEquals(calls[5], mock.call(
             msg={'repo': u'f18-updates',
                  'updates': [u'bodhi-2.0-1.fc18']},
             force=True,
@@ -563,7 +683,7 @@ References:
 
         self.msg['body']['msg']['updates'] += ['bodhi-2.0-1.fc18']
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         # Ensure that F18 and F17 run in parallel
         calls = publish.mock_calls
@@ -589,6 +709,342 @@ References:
                 topic='mashtask.mashing'))
 
 
+    def test_schedule_repos(self):
+        important = [(u'F18', 'testing', []), (u'F18', 'stable', [])]
+        normal = [(u'F17', 'testing', []), (u'F17', 'stable', [])]
+        repos = [(release, request) for release, request, updates in
+                 self.masher.schedule_repos((important, normal))]
+        self.assertEquals(repos, [(u'F18', 'stable'), (u'F18', 'testing'),
+                                  (u'F17', 'stable'), (u'F17', 'testing')])
+
+    def _add_testing_updates(self, count):
+        """Add `count` more F17 testing updates, and return all of the titles"""
+        titles = [u'bodhi-2.0-1.fc17']
+        with self.db_factory() as db:
+            up = db.query(Update).one()
+            for i in range(count):
+                build = Build(nvr=u'pkg%d-1.0-1.fc17' % i,
+                              release=up.release,
+                              package=up.builds[0].package)
+                update = Update(
+                    title=build.nvr, builds=[build], user=up.user,
+                    status=UpdateStatus.pending,
+                    request=UpdateRequest.testing,
+                    notes=u'Useful details!', release=up.release)
+                update.type = UpdateType.bugfix
+                update.bugs.append(Bug(bug_id=54321 + i))
+                db.add(update)
+                titles.append(build.nvr)
+        return titles
+
+    @mock.patch.dict(config, {'mash_update_chunk_size': '2'})
+    def test_chunk_updates(self):
+        titles = self._add_testing_updates(4)
+        t = MasherThread(u'F17', u'testing', titles,
+                         log, self.db_factory, self.tempdir)
+
+        def loaded(cls):
+            return len([obj for obj in t.db.identity_map.values()
+                        if isinstance(obj, cls)])
+
+        with self.db_factory() as session:
+            t.db = session
+            t.load_updates()
+            self.assertEquals(loaded(Update), 5)
+
+            chunks = []
+            for chunk in t.chunk_updates():
+                chunk[0].notes = u'Edited'
+                # Only the updates of this chunk are held in the session
+                self.assertEquals(loaded(Update), len(chunk))
+                self.assertEquals(loaded(Build), len(chunk))
+                self.assertEquals(loaded(Bug), len(chunk))
+                chunks.append(map(attrgetter('title'), chunk))
+            self.assertEquals(chunks, [titles[0:2], titles[2:4], titles[4:]])
+
+            # The changes to each chunk were flushed before it was let go
+            self.assertEquals(
+                session.query(Update).filter_by(notes=u'Edited').count(), 3)
+
+            # Stages that go through every update do so a chunk at a time
+            t.koji = buildsys.get_session()
+            t.prefetch_headers()
+            self.assertEquals(loaded(Update), 0)
+
+            # The updates are loaded again when needed
+            self.assertEquals(map(attrgetter('title'), t.updates), titles)
+            t.db = None
+
+    def test_compose_atomic_trees(self):
+        composer = mock.Mock()
+        atomic_config = {'releases': {
+            u'f17-updates': {'arch': 'x86_64', 'repos': {}},
+            u'f18-updates': {'arch': 'x86_64', 'repos': {}},
+            u'f19-updates': {'arch': 'x86_64', 'repos': {}},
+        }}
+        composed = []
+
+        def compose(release):
+            composed.append(release['repos']['updates'])
+            if 'f18' in release['repos']['updates']:
+                raise Exception('rpm-ostree died')
+            return {'result': 'success'}
+        composer.composer.AtomicComposer.return_value.compose.side_effect = \
+            compose
+        composer.config.config = atomic_config
+
+        t = MasherThread(u'F17', u'stable', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.id = 'f17-updates'
+        t.init_state()
+        t.state['completed_repos'] = [
+            os.path.join(self.tempdir, u'%s-151018.1200' % tag)
+            for tag in sorted(atomic_config['releases'])]
+        with mock.patch.dict('sys.modules', {
+                'fedmsg_atomic_composer': composer,
+                'fedmsg_atomic_composer.composer': composer.composer,
+                'fedmsg_atomic_composer.config': composer.config}):
+            with self.assertRaises(Exception) as failure:
+                t.compose_atomic_trees()
+            self.assertEquals(str(failure.exception),
+                              'f18-updates atomic compose failed')
+
+            # The other trees were still composed
+            self.assertEquals(len(composed), 3)
+
+            del atomic_config['releases'][u'f18-updates']
+            results = t.compose_atomic_trees()
+            t.remove_state()
+        self.assertEquals(sorted(results), [u'f17-updates', u'f19-updates'])
+        self.assertEquals(results[u'f17-updates']['result'], 'success')
+        self.assertIn('time', results[u'f17-updates'])
+
+    def test_repo_lease(self):
+        session = sessionmaker(bind=DBSession().get_bind())()
+        tag = u'f17-updates-testing'
+        self.assertTrue(RepoLease.acquire(session, tag, u'a', 600))
+        self.assertFalse(RepoLease.acquire(session, tag, u'b', 600))
+        self.assertEquals(RepoLease.holder(session, tag), u'a')
+        self.assertTrue(RepoLease.renew(session, tag, u'a'))
+        self.assertFalse(RepoLease.renew(session, tag, u'b'))
+
+        # A lease that hasn't been renewed in time is reclaimed
+        lease = session.query(RepoLease).filter_by(tag=tag).one()
+        lease.heartbeat = datetime.utcnow() - timedelta(seconds=601)
+        session.commit()
+        self.assertTrue(RepoLease.acquire(session, tag, u'b', 600))
+        self.assertFalse(RepoLease.renew(session, tag, u'a'))
+
+        RepoLease.release(session, tag, u'b')
+        self.assertIsNone(RepoLease.holder(session, tag))
+        session.close()
+
+    @mock.patch('bodhi.notifications.publish')
+    def test_leased_repo_is_skipped(self, publish):
+        session = sessionmaker(bind=DBSession().get_bind())()
+        RepoLease.acquire(session, u'f17-updates-testing', u'otherhost', 600)
+        session.close()
+
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.run()
+
+        # The other masher is pushing the repo, so we leave it alone
+        self.assertEquals(publish.call_count, 0)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tempdir, 'MASHING-f17-updates-testing')))
+
+    def test_push_queue(self):
+        path = os.path.join(self.tempdir, 'push-queue.json')
+        queue = PushQueue(path)
+        queue.add(u'F17', 'testing', [u'a'])
+        queue.add(u'F17', 'stable', [u'b'])
+        queue.add(u'F18', 'testing', [u'c'], important=True)
+
+        # Requests for a waiting repo are merged into one push
+        queue.add(u'F17', 'testing', [u'a', u'd'])
+        self.assertEquals(len(queue.entries), 3)
+        self.assertEquals(queue.entries[0]['updates'], [u'a', u'd'])
+
+        # Important repos come first, then stable ones
+        f18 = queue.next()
+        self.assertEquals(f18['release'], u'F18')
+        self.assertEquals(queue.next()['request'], 'stable')
+
+        # A request for a running repo waits for it to finish
+        queue.add(u'F18', 'testing', [u'e'])
+        self.assertEquals(queue.next()['updates'], [u'a', u'd'])
+
+        # The queue survives a restart, and the interrupted pushes resume
+        queue = PushQueue(path)
+        self.assertEquals(len(queue.entries), 4)
+        self.assertTrue(all(entry['resume'] for entry in queue.entries[:3]))
+        self.assertFalse(queue.entries[3]['resume'])
+
+        # Updates are never merged into a resumed push, whose updates come
+        # from its saved state
+        queue.add(u'F17', 'stable', [u'f'])
+        self.assertEquals(len(queue.entries), 5)
+        self.assertEquals(queue.entries[4]['updates'], [u'f'])
+
+    def test_push_queue_waits_for_running_repo(self):
+        queue = PushQueue()
+        queue.add(u'F17', 'testing', [u'a'])
+        running = queue.next()
+        queue.add(u'F17', 'testing', [u'b'])
+
+        timer = threading.Timer(0.1, queue.done, [running])
+        timer.start()
+        # Blocks until the running push of the repo is done
+        self.assertEquals(queue.next()['updates'], [u'b'])
+        self.assertEquals(queue.entries[0]['updates'], [u'b'])
+        timer.join()
+
+    def test_consume_only_queues(self):
+        started, finish = threading.Event(), threading.Event()
+
+        def work(thread):
+            started.set()
+            finish.wait(5)
+
+        with mock.patch.object(MasherThread, 'work', work):
+            # The message is handled while its repo is still being pushed
+            self.masher.consume(self.msg)
+            self.assertTrue(started.wait(5))
+            self.assertTrue(self.masher.queue.entries[0]['running'])
+            finish.set()
+            self.masher.queue.join()
+
+    def test_queue_is_pushed_at_startup(self):
+        self.masher.stop()
+        queue = PushQueue(os.path.join(self.tempdir, 'push-queue.json'))
+        queue.add(u'F17', 'testing', [u'bodhi-2.0-1.fc17'])
+        pushed = []
+
+        with mock.patch.object(MasherThread, 'work',
+                               lambda thread: pushed.append(thread.release)):
+            # The repo left in the queue is pushed without any new message
+            self.masher = Masher(FakeHub(), db_factory=self.db_factory,
+                                 mash_dir=self.tempdir)
+            self.masher.queue.join()
+        self.assertEquals(pushed, [u'F17'])
+
+    @mock.patch('bodhi.notifications.publish')
+    def test_finish_before_path(self, publish):
+        # A push that failed before it chose where to mash
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.id = u'f17-updates-testing'
+        t.finish(False)
+        publish.assert_called_with(topic='mashtask.complete', force=True,
+                                   msg=dict(success=False,
+                                            repo=u'f17-updates-testing'))
+
+    def test_stop(self):
+        pushed = threading.Event()
+        finish = threading.Event()
+
+        def work(thread):
+            pushed.set()
+            finish.wait()
+
+        with mock.patch.object(MasherThread, 'work', work):
+            self.masher.consume(self.msg)
+            pushed.wait()
+            stopper = threading.Thread(target=self.masher.stop)
+            stopper.start()
+            # The running repo is waited for before the consumer stops
+            stopper.join(0.2)
+            self.assertTrue(stopper.is_alive())
+            finish.set()
+            stopper.join()
+        self.assertTrue(self.masher.hub.closed)
+
+    @mock.patch(**mock_taskotron_results)
+    @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
+    @mock.patch('bodhi.consumers.masher.MashThread.run')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_mash')
+    @mock.patch('bodhi.consumers.masher.MasherThread.sanity_check_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.generate_updateinfo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_sync')
+    @mock.patch('bodhi.notifications.publish')
+    @mock.patch('bodhi.util.cmd')
+    def test_resume_without_lock(self, *args):
+        # A push that crashed before its state was first saved
+        self.masher.stop()
+        queue = PushQueue(os.path.join(self.tempdir, 'push-queue.json'))
+        queue.add(u'F17', 'testing', [u'bodhi-2.0-1.fc17'], resume=True)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tempdir, 'MASHING-f17-updates-testing')))
+
+        # is pushed from scratch
+        self.masher = Masher(FakeHub(), db_factory=self.db_factory,
+                             mash_dir=self.tempdir)
+        self.masher.queue.join()
+        with self.db_factory() as session:
+            up = session.query(Update).one()
+            self.assertEquals(up.status, UpdateStatus.testing)
+            self.assertEquals(up.request, None)
+            self.assertFalse(up.locked)
+
+    def _count_concurrent_threads(self, limit):
+        """Push two repos and return how many of them ran at once"""
+        lock = threading.Lock()
+        running, seen = [0], [0]
+
+        def work(thread):
+            with lock:
+                running[0] += 1
+                seen[0] = max(seen[0], running[0])
+            # Give the other repo a chance to start alongside us
+            for i in range(20):
+                if seen[0] > 1:
+                    break
+                time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+
+        self.set_stable_request('bodhi-2.0-1.fc17')
+        with self.db_factory() as db:
+            up = db.query(Update).one()
+            release = Release(
+                name=u'F18', long_name=u'Fedora 18',
+                id_prefix=u'FEDORA', version=u'18',
+                dist_tag=u'f18', stable_tag=u'f18-updates',
+                testing_tag=u'f18-updates-testing',
+                candidate_tag=u'f18-updates-candidate',
+                pending_testing_tag=u'f18-updates-testing-pending',
+                pending_stable_tag=u'f18-updates-pending',
+                override_tag=u'f18-override',
+                branch=u'f18')
+            db.add(release)
+            build = Build(nvr=u'bodhi-2.0-1.fc18', release=release,
+                          package=up.builds[0].package)
+            db.add(build)
+            update = Update(
+                title=u'bodhi-2.0-1.fc18',
+                builds=[build], user=up.user,
+                status=UpdateStatus.pending,
+                request=UpdateRequest.testing,
+                notes=u'Useful details!', release=release)
+            update.type = UpdateType.bugfix
+            db.add(update)
+
+        self.msg['body']['msg']['updates'] += ['bodhi-2.0-1.fc18']
+        with mock.patch.dict(config, {'max_concurrent_mashes': str(limit)}):
+            with mock.patch.object(MasherThread, 'work', work):
+                self.consume(self.msg)
+        return seen[0]
+
+    @mock.patch('bodhi.notifications.publish')
+    def test_testing_repo_does_not_wait_for_stable(self, publish):
+        self.assertEquals(self._count_concurrent_threads(2), 2)
+
+    @mock.patch('bodhi.notifications.publish')
+    def test_max_concurrent_mashes(self, publish):
+        self.assertEquals(self._count_concurrent_threads(1), 1)
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MashThread.run')
     @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_mash')
@@ -599,10 +1055,48 @@ References:
     @mock.patch('bodhi.util.cmd')
     def test_update_comps(self, cmd, *args):
         cmd.return_value = '', '', 0
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
         self.assertIn(mock.call(['git', 'pull'], mock.ANY), cmd.mock_calls)
         self.assertIn(mock.call(['make'], mock.ANY), cmd.mock_calls)
 
+    @mock.patch('bodhi.util.cmd')
+    def test_update_comps_reuses_build(self, cmd):
+        comps_dir = tempfile.mkdtemp()
+        head = ['abc']
+
+        def run(args, cwd):
+            if args == ['git', 'rev-parse', 'HEAD']:
+                return head[0] + '\n', '', 0
+            if args == ['make']:
+                with file(os.path.join(comps_dir, 'comps-f17.xml'), 'w') as f:
+                    f.write(head[0])
+            return '', '', 0
+        cmd.side_effect = run
+
+        def update_comps():
+            t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                             log, self.db_factory, self.tempdir)
+            t.id = 'f17-updates-testing'
+            t.init_state()
+            t.update_comps()
+            t.remove_state()
+            return [c for c in cmd.mock_calls if c == mock.call(['make'],
+                                                                comps_dir)]
+
+        try:
+            with mock.patch.dict(config, {'comps_dir': comps_dir}):
+                self.assertEquals(len(update_comps()), 1)
+                # Later threads reuse the comps that are already built
+                self.assertEquals(len(update_comps()), 1)
+                # Rebuild when the generated comps have been tampered with
+                os.unlink(os.path.join(comps_dir, 'comps-f17.xml'))
+                self.assertEquals(len(update_comps()), 2)
+                # ...or when there are new upstream changes
+                head[0] = 'def'
+                self.assertEquals(len(update_comps()), 3)
+        finally:
+            shutil.rmtree(comps_dir)
+
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MasherThread.sanity_check_repo')
     @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
@@ -632,7 +1126,8 @@ References:
                                 force=True,
                                 msg=mock.ANY)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7,
+                                line_callback=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
 
@@ -663,7 +1158,8 @@ References:
                                    msg=dict(success=True, repo='f17-updates'))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7,
+                                line_callback=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
     @mock.patch(**mock_absent_taskotron_results)
@@ -693,7 +1189,8 @@ References:
                                    msg=dict(success=True, repo='f17-updates'))
         publish.assert_any_call(topic='update.eject', msg=mock.ANY, force=True)
 
-        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7), cmd.mock_calls)
+        self.assertIn(mock.call(['mash'] + [mock.ANY] * 7,
+                                line_callback=mock.ANY), cmd.mock_calls)
         self.assertEquals(len(t.state['completed_repos']), 1)
 
     @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
@@ -708,8 +1205,8 @@ References:
     @mock.patch('bodhi.bugs.bugtracker.modified')
     @mock.patch('bodhi.bugs.bugtracker.on_qa')
     def test_modify_testing_bugs(self, on_qa, modified, *args):
-        self.masher.consume(self.msg)
-        on_qa.assert_called_once_with(12345, u"bodhi-2.0-1.fc17 has been pushed to the Fedora 17 testing repository. If problems still persist, please make note of it in this bug report.\nIf you want to test the update, you can install it with\n$ su -c 'dnf --enablerepo=updates-testing update bodhi'\nYou can provide feedback for this update here: http://0.0.0.0:6543/updates/FEDORA-%s-0001" % time.localtime().tm_year)
+        self.consume(self.msg)
+        on_qa.assert_called_once_with(12345, u"bodhi-2.0-1.fc17 has been pushed to the Fedora 17 testing repository. If problems still persist, please make note of it in this bug report.\nIf you want to test the update, you can install it with\n$ su -c 'dnf --enablerepo=updates-testing update bodhi'\nYou can provide feedback for this update here: http://0.0.0.0:6543/updates/FEDORA-%s-0001" % time.localtime().tm_year, raise_errors=True)
 
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
@@ -732,8 +1229,8 @@ References:
             t.work()
             t.db = None
         close.assert_called_with(
-            12345, versions=dict(bodhi=u'bodhi-2.0-1.fc17'))
-        comment.assert_called_with(12345, u'bodhi-2.0-1.fc17 has been pushed to the Fedora 17 stable repository. If problems still persist, please make note of it in this bug report.')
+            12345, versions=dict(bodhi=u'bodhi-2.0-1.fc17'), raise_errors=True)
+        comment.assert_called_with(12345, u'bodhi-2.0-1.fc17 has been pushed to the Fedora 17 stable repository. If problems still persist, please make note of it in this bug report.', raise_errors=True)
 
     @mock.patch(**mock_taskotron_results)
     @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
@@ -751,7 +1248,7 @@ References:
             up = session.query(Update).filter_by(title=title).one()
             self.assertEquals(len(up.comments), 2)
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -775,7 +1272,7 @@ References:
             up.request = UpdateRequest.stable
             self.assertEquals(len(up.comments), 2)
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -823,7 +1320,7 @@ References:
             up.request = UpdateRequest.stable
             self.assertEquals(len(up.comments), 2)
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -849,7 +1346,7 @@ References:
                 up.status = UpdateStatus.pending
 
             # Simulate a failed push
-            self.masher.consume(self.msg)
+            self.consume(self.msg)
 
         # Ensure that the update hasn't changed state
         with self.db_factory() as session:
@@ -859,7 +1356,322 @@ References:
 
         # Resume the push
         self.msg['body']['msg']['resume'] = True
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
+
+        with self.db_factory() as session:
+            up = session.query(Update).filter_by(title=title).one()
+            self.assertEquals(up.status, UpdateStatus.testing)
+            self.assertEquals(up.request, None)
+
+    @mock.patch.dict(config, {'koji_tag_chunk_size': '2'})
+    def test_chunk_tag_actions(self):
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        actions = [('moveBuild', ('f17-updates-candidate',
+                                  'f17-updates-testing', nvr))
+                   for nvr in (u'bodhi-2.0-1.fc17', u'nethack-3.4-1.fc17',
+                               u'bodhi-2.0-2.fc17', u'kernel-4.0-1.fc17')]
+        chunks = [[args[-1] for method, args in chunk]
+                  for chunk in t._chunk_tag_actions(actions)]
+        self.assertEquals(chunks, [
+            [u'bodhi-2.0-1.fc17', u'bodhi-2.0-2.fc17'],
+            [u'nethack-3.4-1.fc17', u'kernel-4.0-1.fc17']])
+
+    @mock.patch.dict(config, {'koji_tag_chunk_size': '1',
+                              'koji_tag_workers': '2'})
+    def test_tag_workers_reuse_sessions(self):
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.move_tags = [(u'f17-updates-candidate', u'f17-updates-testing', nvr)
+                       for nvr in (u'bodhi-2.0-1.fc17', u'nethack-3.4-1.fc17',
+                                   u'kernel-4.0-1.fc17', u'gcc-5.1-1.fc17')]
+        with mock.patch.object(buildsys, 'get_session',
+                               wraps=buildsys.get_session) as get_session:
+            t._perform_tag_actions()
+
+        # Each worker logs in once, rather than once per chunk
+        self.assertEquals(get_session.call_count, 2)
+        self.assertEquals(sorted(self.koji.__moved__), sorted(t.move_tags))
+
+    def test_retry_failed_tag_actions(self):
+        attempts = []
+
+        @buildsys.multicall_enabled
+        def moveBuild(koji, from_tag, to_tag, build, *args, **kw):
+            attempts.append(build)
+            if len(attempts) == 1:
+                raise Exception('Koji is having a bad day')
+            buildsys.DevBuildsys.__moved__.append((from_tag, to_tag, build))
+
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.move_tags = [(u'f17-updates-candidate', u'f17-updates-testing',
+                        u'bodhi-2.0-1.fc17')]
+        with mock.patch.object(buildsys.DevBuildsys, 'moveBuild', moveBuild):
+            t._perform_tag_actions()
+
+        self.assertEquals(attempts, [u'bodhi-2.0-1.fc17'] * 2)
+        self.assertEquals(self.koji.__moved__, t.move_tags)
+
+    @mock.patch.dict(config, {'koji_tag_retries': '1'})
+    def test_failed_tag_actions(self):
+        @buildsys.multicall_enabled
+        def getTaskInfo(koji, task):
+            return {'state': 5}
+
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.move_tags = [(u'f17-updates-candidate', u'f17-updates-testing',
+                        u'bodhi-2.0-1.fc17')]
+        with mock.patch.object(buildsys.DevBuildsys, 'moveBuild',
+                               buildsys.multicall_enabled(lambda *a, **k: 1)):
+            with mock.patch.object(buildsys.DevBuildsys, 'getTaskInfo',
+                                   getTaskInfo):
+                self.assertRaises(Exception, t._perform_tag_actions)
+
+    def test_wait_for_sync(self):
+        """Watch a local stand-in mirror until every arch has synced"""
+        mirror = tempfile.mkdtemp()
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+
+        def write_repomd(base, content):
+            for arch in ('i386', 'x86_64'):
+                repodata = os.path.join(base, arch, 'repodata')
+                if not os.path.isdir(repodata):
+                    os.makedirs(repodata)
+                with open(os.path.join(repodata, 'repomd.xml'), 'w') as f:
+                    f.write(content)
+
+        def sync(interval):
+            # The thread pool sleeps too, so only react to our polling
+            if interval == 10:
+                write_repomd(os.path.join(mirror, '17'), 'new')
+
+        try:
+            with self.db_factory() as session:
+                t.db = session
+                t.release = session.query(Release).filter_by(name=u'F17').one()
+                t.id = t.release.testing_tag
+                t.path = self.tempdir
+                t.init_state()
+                write_repomd(os.path.join(self.tempdir, t.id), 'new')
+                write_repomd(os.path.join(mirror, '17'), 'old')
+                url = 'file://%s/%%s/%%s/repodata/repomd.xml' % mirror
+                with mock.patch.dict(config, {
+                        'fedora_testing_master_repomd': url}):
+                    with mock.patch('time.sleep', side_effect=sync) as sleep:
+                        with mock.patch('bodhi.notifications.publish') as pub:
+                            sync_times = t.wait_for_sync()
+                t.db = None
+        finally:
+            shutil.rmtree(mirror)
+
+        self.assertEquals(sorted(sync_times.keys()), ['i386', 'x86_64'])
+        self.assertIn(mock.call(10), sleep.call_args_list)
+        pub.assert_called_with(topic='mashtask.sync.done', force=True,
+                               msg=dict(repo=t.id, sync_times=sync_times))
+
+    @mock.patch('bodhi.consumers.masher.time.sleep')
+    @mock.patch('bodhi.consumers.masher.urllib2.urlopen')
+    def test_wait_for_sync_backoff(self, urlopen, sleep):
+        """Back off while the mirror is not modified, and send validators"""
+        not_modified = urllib2.HTTPError('url', 304, 'Not Modified', {}, None)
+        old = mock.Mock()
+        old.read.return_value = 'old'
+        old.info.return_value = {'ETag': '"abc"'}
+        new = mock.Mock()
+        new.read.return_value = 'new'
+        urlopen.side_effect = [old, not_modified, not_modified, new]
+
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.id = 'f17-updates-testing'
+        checksum = hashlib.sha1('new').hexdigest()
+        arch, elapsed = t._wait_for_arch_sync(
+            ('x86_64', 'http://mirror/repomd.xml', checksum, time.time()))
+
+        self.assertEquals(arch, 'x86_64')
+        self.assertEquals(sleep.call_args_list,
+                          [mock.call(10), mock.call(20), mock.call(40)])
+        request = urlopen.call_args[0][0]
+        self.assertEquals(request.get_header('If-none-match'), '"abc"')
+
+    def test_prefetch_headers(self):
+        for cache in (util.rpm_header_cache, util.koji_build_cache,
+                      util.latest_builds_cache):
+            cache.clear()
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.koji = buildsys.get_session()
+        with self.db_factory() as session:
+            t.db = session
+            t.load_updates()
+            with mock.patch.object(buildsys, 'chunked_multicall',
+                                   wraps=buildsys.chunked_multicall) as calls:
+                t.prefetch_headers()
+            self.assertEquals([call[0][1] for call in calls.call_args_list],
+                              ['getBuild', 'getLatestBuilds', 'getRPMHeaders'])
+
+            # The update notices no longer ask koji for anything
+            with mock.patch.object(buildsys.DevBuildsys, 'getRPMHeaders') as h:
+                with mock.patch.object(buildsys.DevBuildsys, 'getBuild') as b:
+                    with mock.patch.object(buildsys.DevBuildsys,
+                                           'getLatestBuilds') as l:
+                        mail.get_template(t.updates[0])
+            self.assertEquals(h.call_count + b.call_count + l.call_count, 0)
+            t.db = None
+
+    def test_mash_progress(self):
+        t = MashThread(u'f17-updates-testing', self.tempdir, 'comps.xml',
+                       '/does/not/exist', log)
+        repo = os.path.join(self.tempdir, u'f17-updates-testing')
+        t.parse_line('Getting package lists for f17-updates-testing...')
+        t.parse_line('Found 1234 packages')
+        t.parse_line('Running createrepo on %s/i386/os...' % repo)
+        t.parse_line('Running createrepo on %s/x86_64...' % repo)
+        os.makedirs(os.path.join(repo, 'i386', 'repodata'))
+        open(os.path.join(repo, 'i386', 'repodata', 'repomd.xml'), 'w').close()
+
+        progress = t.get_progress()
+        self.assertEquals(progress['lines'], 4)
+        self.assertEquals(progress['packages'], 1234)
+        self.assertEquals(progress['last_line'],
+                          'Running createrepo on %s/x86_64...' % repo)
+        self.assertEquals(progress['arches'],
+                          {'i386': 'done', 'x86_64': 'createrepo'})
+
+        # The masher exposes the progress of its running mash
+        masher = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                              log, self.db_factory, self.tempdir)
+        self.assertIsNone(masher.progress)
+        masher.mash_thread = t
+        self.assertEquals(masher.progress['packages'], 1234)
+
+    def test_mash_reuses_unchanged_repo(self):
+        stage_dir = tempfile.mkdtemp()
+        comps_dir = tempfile.mkdtemp()
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.koji = buildsys.get_session()
+        t.id = u'f17-updates-testing'
+        t.init_state()
+        comps = os.path.join(comps_dir, 'comps-f17.xml')
+        with file(comps, 'w') as f:
+            f.write('<comps/>')
+
+        # The previous mash of the tag, which is staged
+        previous = os.path.join(self.tempdir, 'f17-updates-testing-previous')
+        repo = os.path.join(previous, t.id, 'x86_64')
+        os.makedirs(os.path.join(repo, 'repodata'))
+        for name in ('bodhi-2.0-1.fc17.noarch.rpm', 'repodata/repomd.xml'):
+            with file(os.path.join(repo, name), 'w') as f:
+                f.write(name)
+        os.symlink(os.path.join(previous, t.id),
+                   os.path.join(stage_dir, t.id))
+        with file(os.path.join(previous, 'mash.fingerprint'), 'w') as f:
+            f.write(t.fingerprint(comps))
+
+        try:
+            with self.db_factory() as session:
+                t.release = session.query(Release).one()
+                with mock.patch.dict(config, {'mash_stage_dir': stage_dir,
+                                              'comps_dir': comps_dir}):
+                    with mock.patch('bodhi.consumers.masher.MashThread') \
+                            as mash:
+                        t.path = os.path.join(self.tempdir, 'unchanged')
+                        os.makedirs(t.path)
+                        self.assertIsNone(t.mash())
+                        self.assertEquals(mash.call_count, 0)
+
+                        # Nothing changed, so the previous repo is reused
+                        rpm = os.path.join(t.path, t.id, 'x86_64',
+                                           'bodhi-2.0-1.fc17.noarch.rpm')
+                        self.assertTrue(os.path.samefile(
+                            rpm, os.path.join(repo, os.path.basename(rpm))))
+                        repomd = os.path.join(t.path, t.id, 'x86_64',
+                                              'repodata', 'repomd.xml')
+                        self.assertFalse(os.path.samefile(
+                            repomd, os.path.join(repo, 'repodata',
+                                                 'repomd.xml')))
+                        self.assertEquals(t.state['completed_repos'],
+                                          [t.path])
+
+                        # Once the comps change, the tag is mashed again
+                        with file(comps, 'w') as f:
+                            f.write('<comps><group/></comps>')
+                        t.path = os.path.join(self.tempdir, 'changed')
+                        os.makedirs(t.path)
+                        t.mash()
+                        self.assertEquals(mash.call_count, 1)
+                        self.assertFalse(os.path.exists(
+                            os.path.join(t.path, t.id)))
+        finally:
+            t.remove_state()
+            shutil.rmtree(stage_dir)
+            shutil.rmtree(comps_dir)
+
+    def test_prefetch_tags(self):
+        t = MasherThread(u'F17', u'testing', [u'bodhi-2.0-1.fc17'],
+                         log, self.db_factory, self.tempdir)
+        t.koji = buildsys.get_session()
+        t.skip_mash = False
+        with self.db_factory() as session:
+            t.db = session
+            t.load_updates()
+            with mock.patch.object(buildsys, 'chunked_multicall',
+                                   wraps=buildsys.chunked_multicall) as calls:
+                t.prefetch_tags()
+            self.assertEquals(calls.call_count, 1)
+            self.assertEquals(calls.call_args[0][1:3],
+                              ('listTags', [(u'bodhi-2.0-1.fc17',)]))
+
+            # Determining the tag actions no longer asks koji for each build
+            with mock.patch.object(buildsys.DevBuildsys, 'listTags') as tags:
+                t._determine_tag_actions()
+            self.assertEquals(tags.call_count, 0)
+            self.assertEquals(t.move_tags, [(u'f17-updates-candidate',
+                                             u'f17-updates-testing',
+                                             u'bodhi-2.0-1.fc17')])
+            t.db = None
+
+    @mock.patch(**mock_taskotron_results)
+    @mock.patch('bodhi.consumers.masher.MasherThread.update_comps')
+    @mock.patch('bodhi.consumers.masher.MashThread.run')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_mash')
+    @mock.patch('bodhi.consumers.masher.MasherThread.sanity_check_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.stage_repo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.generate_updateinfo')
+    @mock.patch('bodhi.consumers.masher.MasherThread.wait_for_sync')
+    @mock.patch('bodhi.notifications.publish')
+    @mock.patch('bodhi.util.cmd')
+    def test_resume_skips_completed_stages(self, cmd, publish, *args):
+        title = self.msg['body']['msg']['updates'][0]
+
+        # Simulate a push that fails at the very end
+        with mock.patch.object(MasherThread, 'send_testing_digest', mock_exc):
+            self.consume(self.msg)
+
+        self.assertEquals(len(self.koji.__moved__), 1)
+        publish.assert_any_call(topic='update.complete.testing',
+                                msg=mock.ANY, force=True)
+        state = util.StateJournal(
+            os.path.join(self.tempdir, 'MASHING-f17-updates-testing')).replay()
+        self.assertTrue(state['determine_and_perform_tag_actions'])
+        self.assertTrue(state['send_notifications'])
+        self.assertIn(u'Fedora 17', state['generate_testing_digest'])
+
+        self.koji.clear()
+        publish.reset_mock()
+
+        # Resume the push
+        self.msg['body']['msg']['resume'] = True
+        self.consume(self.msg)
+
+        # The builds were already moved, and the notifications already sent
+        self.assertEquals(len(self.koji.__moved__), 0)
+        topics = [call[2]['topic'] for call in publish.mock_calls]
+        self.assertNotIn('update.complete.testing', topics)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -890,7 +1702,7 @@ References:
                 up.request = UpdateRequest.testing
                 up.status = UpdateStatus.pending
                 self.assertEquals(up.stable_karma, 3)
-            self.masher.consume(self.msg)
+            self.consume(self.msg)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -914,7 +1726,7 @@ References:
 
         # finish push and unlock updates
         self.msg['body']['msg']['resume'] = True
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             up = session.query(Update).filter_by(title=title).one()
@@ -943,7 +1755,7 @@ References:
                                            pending_testing_tag]
 
         # Start the push
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             # Set the update request to stable and the release to pending
@@ -952,8 +1764,8 @@ References:
             self.assertIsNone(up.date_stable)
             up.request = UpdateRequest.stable
 
-        # Ensure that fedmsg was called 3 times
-        self.assertEquals(len(publish.call_args_list), 4)
+        # Ensure that fedmsg was called 5 times
+        self.assertEquals(len(publish.call_args_list), 5)
         # Also, ensure we reported success
         publish.assert_called_with(
             topic="mashtask.complete",
@@ -962,7 +1774,7 @@ References:
 
         self.koji.clear()
 
-        self.masher.consume(self.msg)
+        self.consume(self.msg)
 
         with self.db_factory() as session:
             # Check that the request_complete method got run
@@ -15,6 +15,7 @@
 import os
 import glob
 import shutil
+import mock
 import tempfile
 import unittest
 
@@ -27,11 +28,12 @@ import createrepo_c
 
 from bodhi import log
 from bodhi.config import config
-from bodhi.util import mkmetadatadir, get_nvr
+from bodhi.util import mkmetadatadir, get_nvr, build_rpms_cache
 from bodhi.models import (Release, Package, Update, Bug, Build, Base,
         DBSession, UpdateRequest, UpdateStatus, UpdateType)
-from bodhi.buildsys import get_session, DevBuildsys
-from bodhi.metadata import ExtendedMetadata
+from bodhi.buildsys import get_session, DevBuildsys, chunked_multicall
+from bodhi.metadata import (ExtendedMetadata, notice_cache, notice_key,
+                            notice_from_dict)
 from bodhi.tests.functional.base import DB_PATH
 
 from bodhi.tests import populate
@@ -72,10 +74,16 @@ class TestExtendedMetadata(unittest.TestCase):
             'size': 761742,
             'version': '2.0'
         }]
+        build_rpms_cache.clear()
+        notice_cache.clear()
+        # Keep the stored notices out of the source tree
+        self.notice_cache_path = notice_cache.path
+        notice_cache.path = join(self.tempdir, 'notices')
 
     def tearDown(self):
         DBSession.remove()
         get_session().clear()
+        notice_cache.path = self.notice_cache_path
         shutil.rmtree(self.tempdir)
 
     def _verify_updateinfo(self, repodata):
@@ -149,6 +157,110 @@ class TestExtendedMetadata(unittest.TestCase):
         self.assertEquals(pkg.arch, 'src')
         self.assertEquals(pkg.filename, 'TurboGears-1.0.2.2-2.fc7.src.rpm')
 
+    def test_prefetch_rpms(self):
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db,
+                              self.temprepo)
+        build_rpms_cache.clear()
+
+        # The RPMs of every build are listed with one multicall
+        with mock.patch('bodhi.metadata.chunked_multicall',
+                        wraps=chunked_multicall) as multicall:
+            md.prefetch_rpms([update])
+        self.assertEquals(multicall.call_args_list[-1][0][1:3],
+                          ('listBuildRPMs', [(16058,)]))
+
+        # and the notice is then made without asking koji again
+        with mock.patch.object(DevBuildsys, 'listBuildRPMs') as rpms:
+            md.add_update(update)
+        self.assertEquals(rpms.call_count, 0)
+
+    def test_notice_store(self):
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        update.date_pushed = datetime.utcnow()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        md = ExtendedMetadata(update.release, update.request, self.db,
+                              self.temprepo)
+        notice = md.uinfo.updates[0]
+
+        # The notice is stored along with its packages and references
+        stored = notice_from_dict(notice_cache.get(notice_key(update)))
+        self.assertEquals(stored.id, notice.id)
+        self.assertEquals(stored.description, notice.description)
+        self.assertEquals(stored.issued_date, notice.issued_date)
+        self.assertEquals(stored.collections[0].packages[0].filename,
+                          notice.collections[0].packages[0].filename)
+        self.assertEquals([ref.href for ref in stored.references],
+                          [ref.href for ref in notice.references])
+
+        # Without any cached repodata, the notice comes from the store
+        with mock.patch.object(ExtendedMetadata, 'add_update') as add:
+            md = ExtendedMetadata(update.release, update.request, self.db,
+                                  self.temprepo)
+        self.assertEquals(add.call_count, 0)
+        self.assertEquals(md.uinfo.updates[0].title, update.title)
+
+        # until the update is edited
+        old_key = notice_key(update)
+        update.date_modified = datetime.utcnow()
+        with mock.patch.object(ExtendedMetadata, 'add_update') as add:
+            ExtendedMetadata(update.release, update.request, self.db,
+                             self.temprepo)
+        self.assertEquals(add.call_count, 1)
+
+        # Only the latest notice of the update is kept on disk, along with
+        # its key
+        ExtendedMetadata(update.release, update.request, self.db,
+                         self.temprepo)
+        self.assertEquals(len(os.listdir(join(self.tempdir, 'notices'))), 2)
+        notice_cache.clear()
+        self.assertEquals(notice_cache.get(old_key), None)
+        self.assertEquals(notice_cache.get(update.alias), notice_key(update))
+        self.assertNotEquals(notice_cache.get(notice_key(update)), None)
+
+    def test_modifyrepo_every_arch(self):
+        update = self.db.query(Update).one()
+        update.status = UpdateStatus.testing
+        update.request = None
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        mkmetadatadir(join(self.temprepo, 'f17-updates-testing', 'x86_64'))
+
+        md = ExtendedMetadata(update.release, update.request, self.db,
+                              self.temprepo)
+        md.insert_updateinfo()
+
+        # The updateinfo is compressed once and shared by every arch
+        i386 = self._verify_updateinfo(self.repodata)
+        x86_64 = self._verify_updateinfo(join(
+            self.temprepo, 'f17-updates-testing', 'x86_64', 'repodata'))
+        self.assertTrue(os.path.samefile(i386, x86_64))
+        self.assertEquals(os.listdir(self.temprepo), ['f17-updates-testing'])
+
+    def test_modifyrepo_replaces_record(self):
+        update = self.db.query(Update).one()
+        DevBuildsys.__tagged__[update.title] = ['f17-updates-testing']
+        # Put there by something other than bodhi
+        other = join(self.repodata, 'other.xml')
+        file(other, 'w').close()
+
+        md = ExtendedMetadata(update.release, update.request, self.db,
+                              self.temprepo)
+        for notes in ('first', 'second'):
+            fd, name = tempfile.mkstemp(suffix='.xml')
+            os.write(fd, notes)
+            os.close(fd)
+            md.modifyrepo(name)
+            os.unlink(name)
+
+        # Only the file of the record it replaced is removed
+        self._verify_updateinfo(self.repodata)
+        self.assertTrue(exists(other))
+
     def test_extended_metadata_updating(self):
         update = self.db.query(Update).one()
 
@@ -12,9 +12,17 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+import os
+import gzip
+import mock
+import stat
+import shutil
+import tempfile
+
 from bodhi.models import Update
 from bodhi.util import (get_db_from_config, get_critpath_pkgs, markup,
-                        get_rpm_header, cmd)
+                        get_rpm_header, cmd, LRUCache, gzip_contains,
+                        hardlink_tree, StateJournal)
 from bodhi.config import config
 
 
@@ -48,6 +56,95 @@ class TestUtils(object):
         h = get_rpm_header('')
         assert h['name'] == 'libseccomp', h
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        # 'b' was the least recently used entry
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+
+    def test_lru_cache_on_disk(self):
+        path = tempfile.mkdtemp()
+        try:
+            LRUCache(2, path).set('nvr', {'name': 'bodhi'})
+            cache = LRUCache(2, path)
+            assert cache.get('nvr') == {'name': 'bodhi'}
+            assert cache.get('other') is None
+            # The entries can be read by other users
+            with mock.patch('bodhi.util._umask', 022):
+                cache.set('nvr', {'name': 'bodhi'})
+            mode = os.stat(cache._filename('nvr')).st_mode
+            assert stat.S_IMODE(mode) == 0644, oct(mode)
+            cache.delete('nvr')
+            assert os.listdir(path) == []
+            assert LRUCache(2, path).get('nvr') is None
+        finally:
+            shutil.rmtree(path)
+
+    @mock.patch('bodhi.util._umask', 022)
+    def test_state_journal_permissions(self):
+        path = tempfile.mkdtemp()
+        try:
+            journal = StateJournal(os.path.join(path, 'MASHING-f17-updates'))
+            journal.compact({'updates': []})
+            mode = os.stat(journal.path).st_mode
+            assert stat.S_IMODE(mode) == 0644, oct(mode)
+        finally:
+            shutil.rmtree(path)
+
+    def test_cmd_line_callback(self):
+        lines = []
+        out, err, returncode = cmd(['sh', '-c', 'echo a; echo b >&2; echo c'],
+                                   line_callback=lines.append, tail=2)
+        assert lines == ['a', 'b', 'c']
+        # Only the tail of the output is kept
+        assert out == 'b\nc\n'
+        assert err == ''
+        assert returncode == 0
+
+    def test_gzip_contains(self):
+        fd, path = tempfile.mkstemp(suffix='.gz')
+        os.close(fd)
+        try:
+            with gzip.open(path, 'wb') as f:
+                f.write('<update><id>FEDORA-2015-1</id><id/></update>')
+            assert gzip_contains(path, '<id/>')
+            # The text is also found across the boundary between chunks
+            assert gzip_contains(path, '<id/>', chunk_size=3)
+            assert not gzip_contains(path, '<id>FEDORA-2015-2</id>',
+                                     chunk_size=3)
+        finally:
+            os.remove(path)
+
+    def test_hardlink_tree(self):
+        src = tempfile.mkdtemp()
+        dst = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(src, 'x86_64', 'repodata'))
+            rpm = os.path.join(src, 'x86_64', 'bodhi-2.0-1.noarch.rpm')
+            repomd = os.path.join(src, 'x86_64', 'repodata', 'repomd.xml')
+            for path in (rpm, repomd):
+                with open(path, 'w') as f:
+                    f.write(path)
+            os.symlink('x86_64', os.path.join(src, 'i386'))
+
+            target = os.path.join(dst, 'repo')
+            hardlink_tree(src, target, copy=('repodata',))
+
+            linked = os.path.join(target, 'x86_64', 'bodhi-2.0-1.noarch.rpm')
+            assert os.path.samefile(rpm, linked)
+            copied = os.path.join(target, 'x86_64', 'repodata', 'repomd.xml')
+            assert not os.path.samefile(repomd, copied)
+            assert open(copied).read() == repomd
+            assert os.readlink(os.path.join(target, 'i386')) == 'x86_64'
+        finally:
+            shutil.rmtree(src)
+            shutil.rmtree(dst)
+
     def test_cmd_failure(self):
         try:
             cmd('false')
@@ -17,6 +17,9 @@ Random functions that don't fit elsewhere
 """
 
 import os
+import gzip
+import json
+import shutil
 import arrow
 import socket
 import urllib
@@ -29,11 +32,12 @@ import hashlib
 import collections
 import pkg_resources
 import functools
+import threading
 import transaction
 
 from os.path import join, dirname, basename, isfile
 from datetime import datetime
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
 
 from sqlalchemy import create_engine
@@ -57,19 +61,186 @@ header = lambda x: u"%s\n     %s\n%s\n" % ('=' * 80, x, '=' * 80)
 
 pluralize = lambda val, name: val == 1 and name or "%ss" % name
 
+## The umask of the process, read while it is started so that no other thread
+## can create files in between the two umask() calls
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def _rename_into_place(tmp, path):
+    """
+    Atomically replace `path` with a file made by tempfile.mkstemp().
+
+    mkstemp() leaves the file only readable by its owner, so it is first given
+    the permissions of a file made by open(), for the sake of other users such
+    as one running bodhi-push --resume.
+    """
+    os.chmod(tmp, 0666 & ~_umask)
+    os.rename(tmp, path)
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping that holds at most `size` entries, evicting the
+    least recently used ones first.
+
+    If `path` is given, entries are also stored there as JSON files, so that
+    values which never change can outlive the process.
+    """
+    def __init__(self, size, path=None):
+        self.size = size
+        self.path = path
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _filename(self, key):
+        return join(self.path, hashlib.sha1(repr(key)).hexdigest() + '.json')
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.data:
+                value = self.data.pop(key)
+                self.data[key] = value
+                return value
+        if self.path and isfile(self._filename(key)):
+            try:
+                with open(self._filename(key)) as f:
+                    value = json.load(f)
+            except ValueError:
+                log.warning('Ignoring corrupt cache entry for %r', key)
+            else:
+                self.set(key, value, persist=False)
+                return value
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def set(self, key, value, persist=True):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+        if self.path and persist:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(value, f)
+            _rename_into_place(tmp, self._filename(key))
+
+    def delete(self, key):
+        """Forget the entry for `key`, and remove it from disk"""
+        with self.lock:
+            self.data.pop(key, None)
+        if self.path:
+            try:
+                os.unlink(self._filename(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+class StateJournal(object):
+    """
+    A crash safe record of a dict of state, kept in the file at `path`.
+
+    The file starts with a snapshot of the whole state as a JSON object, which
+    is followed by one JSON list per change made since, each fsynced as it is
+    appended.  A crash can at worst truncate the last change, which is ignored
+    when the journal is replayed.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def compact(self, state):
+        """Atomically replace the journal with a snapshot of `state`"""
+        fd, tmp = tempfile.mkstemp(dir=dirname(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+            f.write('\n')
+            f.flush()
+            os.fsync(f.fileno())
+        _rename_into_place(tmp, self.path)
+
+    def append(self, op, key, value=None):
+        """
+        Record a change of the state: 'set' a key to a value, or 'append' a
+        value to or 'remove' it from the list at a key.
+        """
+        with open(self.path, 'a') as f:
+            f.write(json.dumps([op, key, value]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replay(self):
+        """Return the state recorded by the journal"""
+        state = {}
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        for i, line in enumerate(lines):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                if i < len(lines) - 1:
+                    raise
+                log.warning('Ignoring the truncated end of %s', self.path)
+                break
+            if isinstance(entry, dict):
+                state = entry
+                continue
+            op, key, value = entry
+            if op == 'set':
+                state[key] = value
+            elif op == 'append':
+                state.setdefault(key, []).append(value)
+            elif op == 'remove':
+                if value in state.get(key, []):
+                    state[key].remove(value)
+            else:
+                raise ValueError('Unknown journal entry: %r' % line)
+        return state
+
+    def remove(self):
+        os.remove(self.path)
+
+
+## Koji data which never changes for a given NVR, such as its rpm headers
+koji_cache_size = int(config.get('koji_cache_size', 5000))
+koji_cache_dir = config.get('koji_cache_dir')
+rpm_header_cache = LRUCache(koji_cache_size,
+                            koji_cache_dir and join(koji_cache_dir, 'headers'))
+koji_build_cache = LRUCache(koji_cache_size,
+                            koji_cache_dir and join(koji_cache_dir, 'builds'))
+build_rpms_cache = LRUCache(koji_cache_size,
+                            koji_cache_dir and join(koji_cache_dir, 'rpms'))
+
+## The latest builds of each (tag, package), which are refreshed by
+## Build.prefetch_headers before every batch of update notices.
+latest_builds_cache = LRUCache(koji_cache_size)
+
+rpm_headers = [
+    'name', 'summary', 'version', 'release', 'url', 'description',
+    'changelogtime', 'changelogname', 'changelogtext',
+]
+
 
 def get_rpm_header(nvr, tries=0):
     """ Get the rpm header for a given build """
 
+    cached = rpm_header_cache.get(nvr)
+    if cached is not None:
+        return cached
+
     tries += 1
-    headers = [
-        'name', 'summary', 'version', 'release', 'url', 'description',
-        'changelogtime', 'changelogname', 'changelogtext',
-    ]
     rpmID = nvr + '.src'
     koji_session = buildsys.get_session()
     try:
-        result = koji_session.getRPMHeaders(rpmID=rpmID, headers=headers)
+        result = koji_session.getRPMHeaders(rpmID=rpmID, headers=rpm_headers)
     except Exception as e:
         msg = "Failed %i times to get rpm header data from koji for %s:  %s"
         log.warning(msg % (tries, nvr, str(e)))
@@ -81,6 +252,7 @@ def get_rpm_header(nvr, tries=0):
             raise
 
     if result:
+        rpm_header_cache.set(nvr, result)
         return result
 
     raise ValueError("No rpm headers found in koji for %r" % nvr)
@@ -248,10 +420,52 @@ def sanity_check_repodata(myurl):
         raise RepodataException(msg)
 
     updateinfo = os.path.join(myurl, 'updateinfo.xml.gz')
-    if os.path.exists(updateinfo):
-        ret = subprocess.call(['zgrep', '<id/>', updateinfo])
-        if not ret:
-            raise RepodataException('updateinfo.xml.gz contains empty ID tags')
+    if os.path.exists(updateinfo) and gzip_contains(updateinfo, '<id/>'):
+        raise RepodataException('updateinfo.xml.gz contains empty ID tags')
+
+
+def gzip_contains(path, text, chunk_size=1024 * 1024):
+    """
+    Return whether a gzipped file contains `text`, decompressing it a chunk
+    at a time rather than reading it all into memory.
+    """
+    overlap = len(text) - 1
+    tail = ''
+    with gzip.open(path, 'rb') as f:
+        for chunk in iter(functools.partial(f.read, chunk_size), ''):
+            # Also look for the text across the boundary between chunks
+            if text in tail + chunk[:overlap] or text in chunk:
+                return True
+            tail = (tail + chunk)[-overlap:] if overlap else ''
+    return False
+
+
+def hardlink_tree(src, dst, copy=()):
+    """
+    Recreate the tree at `src` under `dst` out of hard links to its files.
+
+    Directories named in `copy` are copied instead, so that the files in them
+    can be rewritten without touching the originals.  Symlinks are recreated
+    as they are.
+    """
+    for root, dirs, files in os.walk(src):
+        target = join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in list(dirs):
+            path = join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), join(target, name))
+                dirs.remove(name)
+            elif name in copy:
+                shutil.copytree(path, join(target, name), symlinks=True)
+                dirs.remove(name)
+        for name in files:
+            path = join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), join(target, name))
+            else:
+                os.link(path, join(target, name))
 
 
 def age(context, date, nuke_ago=False):
@@ -542,10 +756,31 @@ def sorted_updates(updates):
     return ordered_updates[::-1]
 
 
-def cmd(cmd, cwd=None):
+def cmd(cmd, cwd=None, line_callback=None, tail=1000):
+    """
+    Run a command, returning its output, errors and return code.
+
+    If a `line_callback` is given, the output is streamed instead of being
+    buffered: stderr is merged into stdout, every line is passed to the
+    callback as soon as it is printed, and only the last `tail` lines are
+    kept and returned as the output.
+    """
     log.info('Running %r', cmd)
     if isinstance(cmd, basestring):
         cmd = cmd.split()
+    if line_callback is not None:
+        p = subprocess.Popen(cmd, cwd=cwd, bufsize=1,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        lines = collections.deque(maxlen=tail)
+        for line in iter(p.stdout.readline, ''):
+            lines.append(line)
+            line_callback(line.rstrip('\n'))
+        p.stdout.close()
+        p.wait()
+        if p.returncode != 0:
+            log.error('return code %s', p.returncode)
+        return ''.join(lines), '', p.returncode
     p = subprocess.Popen(cmd, cwd=cwd,
                          stdout=subprocess.PIPE,
                          stderr=subprocess.PIPE)
@@ -571,8 +806,25 @@ def tokenize(string):
                     yield token
 
 
-def taskotron_results(settings, entity='results', **kwargs):
-    """ Given an update object, yield resultsdb results. """
+def http_session(pool_size=10):
+    """
+    Return a requests session that keeps up to `pool_size` connections to
+    each host alive, for reuse by the threads that share it.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def taskotron_results(settings, entity='results', session=None, **kwargs):
+    """ Given an update object, yield resultsdb results.
+
+    The pages of results are fetched through `session`, if given, so that
+    its connections are reused.
+    """
     url = settings['resultsdb_api_url'] + "/api/v1.0/" + entity
     if kwargs:
         url = url + "?" + urllib.urlencode(kwargs)
@@ -581,7 +833,7 @@ def taskotron_results(settings, entity='results', **kwargs):
     try:
         while data:
             log.debug("Grabbing %r" % url)
-            response = requests.get(url)
+            response = (session or requests).get(url)
             if response.status_code != 200:
                 raise IOError("status code was %r" % response.status_code)
             json = response.json()